@@ -0,0 +1,123 @@
+# ----------------------------------------------------------------------------
+# Copyright (c) 2016-2021, QIIME 2 development team.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# ----------------------------------------------------------------------------
+
+import functools
+
+import numpy as np
+import pandas as pd
+from scipy.special import gammaln
+
+
+class _RowStats:
+    """Per-sample reductions over a samples x features CSR matrix, computed
+    on first use and shared between the metrics that need them."""
+
+    def __init__(self, counts):
+        counts = counts.tocsr()
+        counts.eliminate_zeros()
+        self.counts = counts.data
+        self.indptr = counts.indptr
+        self.n_samples = counts.shape[0]
+        self.rows = np.repeat(np.arange(self.n_samples),
+                              np.diff(self.indptr))
+
+    def row_sum(self, values):
+        return np.bincount(self.rows, weights=values,
+                           minlength=self.n_samples)
+
+    @functools.cached_property
+    def total(self):
+        return self.row_sum(self.counts)
+
+    @functools.cached_property
+    def observed(self):
+        return np.diff(self.indptr)
+
+    @functools.cached_property
+    def frequencies(self):
+        return self.counts / self.total[self.rows]
+
+    @functools.cached_property
+    def entropy(self):
+        # natural log
+        p = self.frequencies
+        return -self.row_sum(p * np.log(p))
+
+    @functools.cached_property
+    def dominance(self):
+        return self.row_sum(self.frequencies ** 2)
+
+    @functools.cached_property
+    def sum_of_squares(self):
+        return self.row_sum(self.counts ** 2)
+
+    @functools.cached_property
+    def singles(self):
+        return self.row_sum(self.counts == 1)
+
+    @functools.cached_property
+    def doubles(self):
+        return self.row_sum(self.counts == 2)
+
+    @functools.cached_property
+    def maximum(self):
+        maximum = np.zeros(self.n_samples)
+        nonempty = self.observed > 0
+        maximum[nonempty] = np.maximum.reduceat(
+            self.counts, self.indptr[:-1][nonempty])
+        return maximum
+
+
+# Each metric matches the scikit-bio implementation of the same name that
+# `diversity alpha` would otherwise dispatch to.
+_batch_metrics = {
+    'observed_features': lambda s: s.observed.astype(int),
+    'shannon': lambda s: s.entropy / np.log(2),
+    'pielou_e': lambda s: s.entropy / np.log(s.observed),
+    'heip_e': lambda s: (np.exp(s.entropy) - 1) / (s.observed - 1),
+    'simpson': lambda s: 1 - s.dominance,
+    'dominance': lambda s: s.dominance,
+    'enspie': lambda s: 1 / s.dominance,
+    'simpson_e': lambda s: 1 / (s.dominance * s.observed),
+    'berger_parker_d': lambda s: s.maximum / s.total,
+    'singles': lambda s: s.singles.astype(int),
+    'doubles': lambda s: s.doubles.astype(int),
+    'chao1': lambda s: (s.observed +
+                        s.singles * (s.singles - 1) / (2 * (s.doubles + 1))),
+    'goods_coverage': lambda s: 1 - s.singles / s.total,
+    'margalef': lambda s: (s.observed - 1) / np.log(s.total),
+    'menhinick': lambda s: s.observed / np.sqrt(s.total),
+    'mcintosh_d': lambda s: ((s.total - np.sqrt(s.sum_of_squares)) /
+                             (s.total - np.sqrt(s.total))),
+    'mcintosh_e': lambda s: (np.sqrt(s.sum_of_squares) /
+                             np.sqrt((s.total - s.observed + 1) ** 2 +
+                                     s.observed - 1)),
+    'brillouin_d': lambda s: ((gammaln(s.total + 1) -
+                               s.row_sum(gammaln(s.counts + 1))) / s.total),
+}
+
+
+def _alpha_batch(table, metrics):
+    """Compute several alpha diversity metrics in one pass over `table`.
+
+    Every metric must be a key of `_batch_metrics`. Intermediate reductions
+    (totals, frequencies, entropy, ...) are computed once per table and shared
+    by all of the requested metrics. Returns a DataFrame indexed by sample ID
+    with one column per metric.
+    """
+    unsupported = set(metrics) - set(_batch_metrics)
+    if unsupported:
+        raise ValueError('Unsupported batch alpha metric(s): %s.'
+                         % ', '.join(sorted(unsupported)))
+
+    stats = _RowStats(table.matrix_data.T)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        results = {metric: _batch_metrics[metric](stats)
+                   for metric in metrics}
+    return pd.DataFrame(results, index=table.ids(axis='sample'),
+                        columns=list(metrics))
@@ -12,6 +12,7 @@ import pkg_resources
 import shutil
 from urllib.parse import quote
 import functools
+import warnings
 
 import scipy
 import numpy as np
@@ -20,13 +21,23 @@ import qiime2
 from statsmodels.sandbox.stats.multicomp import multipletests
 import q2templates
 import biom
+import biom.util
 import itertools
+import q2_diversity_lib
 
 from . import METRICS
+from ._batch import _alpha_batch, _batch_metrics
+from .._subsample import _DepthSortedCounts, _nested_rarefy
+from .._parallel import _resolve_n_jobs, _parallel_map
+from q2_types.feature_table import BIOMV210Format
 from q2_types.tree import NewickFormat
 
 TEMPLATES = pkg_resources.resource_filename('q2_diversity', '_alpha')
 
+# The most samples plotted individually by `alpha_rarefaction` when compact
+# output is requested.
+_compact_plotted_samples = 500
+
 
 def alpha_group_significance(output_dir: str, alpha_diversity: pd.Series,
                              metadata: qiime2.Metadata) -> None:
@@ -247,24 +258,51 @@ def _reindex_with_metadata(column, columns, merged):
 
 
 def _compute_summary(data, id_label, counts=None):
-    perc = [0.02, 0.09, 0.25, 0.5, 0.75, 0.91, 0.98]
-    describer = functools.partial(pd.DataFrame.describe, percentiles=perc)
-    summary_df = data.stack(level=0)
-    summary_df = summary_df.apply(describer, axis=1)
-    summary_df.drop(['std', 'mean'], axis=1, inplace=True)
-    if counts is not None:
-        summary_df.drop('count', axis=1, inplace=True)
-        stacked_counts = counts.stack(level=0)
-        # There will always be at least one iteration, so we grab the first
-        stacked_counts = stacked_counts[[1]]
-        stacked_counts.rename(columns={1: 'count'}, inplace=True)
-        summary_df = summary_df.join(stacked_counts, how='inner')
-    else:
+    perc = [2, 9, 25, 50, 75, 91, 98]
+    depth_label = data.columns.names[0]
+    depths = np.sort(data.columns.get_level_values(0).unique())
+    iters = np.sort(data.columns.get_level_values(1).unique())
+
+    # (rows, depths, iterations), so every summary statistic is computed in
+    # a single pass over the iteration axis
+    columns = pd.MultiIndex.from_product([depths, iters],
+                                         names=data.columns.names)
+    values = data.reindex(columns=columns).to_numpy(dtype=float)
+    values = values.reshape(len(data.index), len(depths), len(iters))
+
+    # Rows without any observations at a depth (e.g. samples shallower than
+    # that depth) aren't summarized
+    observed = ~np.isnan(values).all(axis=2)
+    values = values[observed]
+
+    summary_df = pd.DataFrame({
+        id_label: np.repeat(data.index.to_numpy(), len(depths))[
+            observed.ravel()],
+        depth_label: np.tile(depths, len(data.index))[observed.ravel()]})
+    if counts is None:
         # Reset count (this should always be one if we weren't explicitly
         # passed counts)
         summary_df['count'] = 1
-    summary_df = summary_df.reset_index()
-    summary_df.rename(columns={'level_0': id_label}, inplace=True)
+    # np.nanpercentile falls back to a per-row loop when reducing over a
+    # short trailing axis, so the (linearly interpolated) percentiles are
+    # computed from the sorted iterations directly. NaNs sort last.
+    values = np.sort(values, axis=1)
+    last = (~np.isnan(values)).sum(axis=1) - 1
+    summary_df['min'] = values[:, 0]
+    for p in perc:
+        position = p / 100 * last
+        lower = np.floor(position).astype(int)
+        upper = np.ceil(position).astype(int)
+        lower_values = np.take_along_axis(values, lower[:, None], axis=1)[:, 0]
+        upper_values = np.take_along_axis(values, upper[:, None], axis=1)[:, 0]
+        summary_df['%d%%' % p] = (lower_values + (upper_values - lower_values)
+                                  * (position - lower))
+    summary_df['max'] = np.take_along_axis(values, last[:, None], axis=1)[:, 0]
+    if counts is not None:
+        # There will always be at least one iteration, so we grab the first
+        first_counts = counts.xs(iters[0], axis=1, level=1)
+        first_counts = first_counts.reindex(index=data.index, columns=depths)
+        summary_df['count'] = first_counts.to_numpy()[observed].astype(int)
     return summary_df
 
 
@@ -275,49 +313,258 @@ def _alpha_rarefaction_jsonp(output_dir, filename, metric, data, column):
         fh.write(");")
 
 
+def _alpha_rarefaction_csv(output_dir, filename, data, metadata,
+                           chunksize=1000):
+    # Written a chunk of samples at a time, so the results joined with the
+    # metadata are never materialized for the whole table at once.
+    columns = ['depth-%d_iter-%d' % (t[0], t[1])
+               for t in data.columns.values]
+    if metadata is not None:
+        metadata = metadata.to_dataframe()
+    with open(os.path.join(output_dir, filename), 'w') as fh:
+        for start in range(0, len(data.index), chunksize):
+            chunk = data.iloc[start:start + chunksize].set_axis(columns,
+                                                                axis=1)
+            if metadata is not None:
+                chunk = chunk.join(metadata, how='left')
+            chunk.to_csv(fh, index_label=['sample-id'], header=start == 0)
+
+
+def _alpha_rarefaction_npz(output_dir, filename, data):
+    iterations = data.columns.get_level_values(1).unique()
+    values = data.to_numpy().reshape(len(data.index), -1, len(iterations))
+    np.savez_compressed(
+        os.path.join(output_dir, filename), values=values,
+        sample_ids=data.index.to_numpy(dtype=str),
+        depths=data.columns.get_level_values(0)[::len(iterations)].to_numpy(),
+        iterations=iterations.to_numpy())
+
+
+def _alpha_rarefaction_iterations(output_dir, filename, data):
+    # An iteration was computed at a depth if any metric has a value for any
+    # sample in it
+    computed = None
+    for frame in data.values():
+        observed = frame.notna().any(axis=0)
+        computed = observed if computed is None else computed | observed
+    used = computed.groupby(level=0, sort=False).sum()
+    used.index.name = 'depth'
+    used.rename('iterations').to_csv(os.path.join(output_dir, filename))
+
+
+def _compute_rarefaction_task(shared, task):
+    counts, phylogeny, metrics = shared
+    depths, i, seed = task
+
+    # The metric functions are called directly on the in-memory rarefied
+    # tables rather than through the alpha actions: there is no provenance to
+    # capture for these intermediate results, and the artifact round-trips
+    # would otherwise dominate the cost of each cell on small tables.
+    batch = [m for m in metrics if m in _batch_metrics]
+    others = [m for m in metrics if m not in _batch_metrics]
+
+    results = []
+    for depth, rt in _nested_rarefy(counts, depths,
+                                    np.random.default_rng(seed)):
+        vectors = dict(_alpha_batch(rt, batch).items())
+        for metric in others:
+            vectors[metric] = _compute_alpha(rt, phylogeny, metric)
+        results.append((depth, i, vectors))
+    return results
+
+
+def _compute_alpha(table, phylogeny, metric):
+    if metric in (METRICS['PHYLO']['IMPL'] | METRICS['PHYLO']['UNIMPL']):
+        # the phylogenetic metrics read the table from a BIOM v2.1 file
+        table_fp = BIOMV210Format()
+        with biom.util.biom_open(str(table_fp), 'w') as fh:
+            table.to_hdf5(fh, generated_by='q2-diversity')
+        function = getattr(q2_diversity_lib,
+                           METRICS['NAME_TRANSLATIONS'][metric])
+        return function(table=table_fp,
+                        phylogeny=NewickFormat(phylogeny, mode='r'))
+    elif metric in METRICS['NONPHYLO']['IMPL']:
+        function = getattr(q2_diversity_lib,
+                           METRICS['NAME_TRANSLATIONS'][metric])
+        return function(table=table)
+    else:
+        return q2_diversity_lib.alpha_passthrough(table=table, metric=metric)
+
+
 def _compute_rarefaction_data(feature_table, min_depth, max_depth, steps,
-                              iterations, phylogeny, metrics):
-    depth_range = np.linspace(min_depth, max_depth, num=steps, dtype=int)
+                              iterations, phylogeny, metrics, nested=False,
+                              n_jobs=1, depth_tolerance=None,
+                              iteration_tolerance=None, min_iterations=None,
+                              groupings=None):
+    # converted and sorted once, and shared by every rarefaction
+    counts = _DepthSortedCounts(feature_table)
+    compute = functools.partial(
+        _compute_rarefaction_depths, counts, iterations=iterations,
+        phylogeny=phylogeny, metrics=metrics, nested=nested, n_jobs=n_jobs,
+        iteration_tolerance=iteration_tolerance,
+        min_iterations=min_iterations, groupings=groupings)
+
+    if depth_tolerance is None:
+        return compute(np.linspace(min_depth, max_depth, num=steps,
+                                   dtype=int))
+
+    # Adaptive depths: start from a coarse grid, then repeatedly split the
+    # depth intervals over which a curve is still changing, until either no
+    # interval changes by more than `depth_tolerance` or `steps` depths have
+    # been computed.
+    depth_range = np.unique(np.linspace(
+        min_depth, max_depth, num=min(steps, max(3, steps // 4)), dtype=int))
+    data = compute(depth_range)
+    while len(depth_range) < steps:
+        new_depths = _refine_depths(data, depth_range, depth_tolerance,
+                                    steps - len(depth_range))
+        if not len(new_depths):
+            break
+        new_data = compute(new_depths)
+        data = {metric: pd.concat([data[metric], new_data[metric]],
+                                  axis=1).sort_index(axis=1)
+                for metric in data}
+        depth_range = np.sort(np.concatenate([depth_range, new_depths]))
+    return data
+
+
+def _refine_depths(data, depth_range, tolerance, budget):
+    """Return the midpoints of the (at most `budget`) depth intervals over
+    which any metric's curve changes the most, provided that change exceeds
+    `tolerance` as a fraction of the metric's range.
+
+    A metric's curve over an interval is summarized by the median, across
+    samples, of the change in each sample's mean over iterations.
+    """
+    change = np.zeros(len(depth_range) - 1)
+    for frame in data.values():
+        values = frame.to_numpy().reshape(len(frame.index), len(depth_range),
+                                          -1)
+        # Iterations that weren't needed at a depth are NaN, as are samples
+        # that weren't rarefied at it
+        with np.errstate(invalid='ignore'):
+            curves = (np.nansum(values, axis=2) /
+                      (~np.isnan(values)).sum(axis=2))
+        scale = np.nanmax(curves) - np.nanmin(curves)
+        if not scale > 0:
+            continue
+        steps = np.diff(curves, axis=1)
+        observed = ~np.isnan(steps).all(axis=0)
+        change[observed] = np.maximum(
+            change[observed],
+            np.abs(np.nanmedian(steps[:, observed], axis=0)) / scale)
+
+    splittable = (change > tolerance) & (np.diff(depth_range) > 1)
+    intervals = np.flatnonzero(splittable)
+    intervals = intervals[np.argsort(-change[intervals], kind='stable')]
+    intervals = np.sort(intervals[:budget])
+    return (depth_range[intervals] + depth_range[intervals + 1]) // 2
+
+
+def _compute_rarefaction_depths(counts, depth_range, iterations,
+                                phylogeny, metrics, nested, n_jobs,
+                                iteration_tolerance=None, min_iterations=None,
+                                groupings=None):
     iter_range = range(1, iterations + 1)
 
-    rows = feature_table.ids(axis='sample')
+    rows = pd.Index(counts.sample_ids)
     cols = pd.MultiIndex.from_product(
         [list(depth_range), list(iter_range)],
         names=['_alpha_rarefaction_depth_column_', 'iter'])
-    data = {k: pd.DataFrame(np.NaN, index=rows, columns=cols)
-            for k in metrics}
-
-    with qiime2.sdk.Context() as scope:
-        feature_table = scope.ctx.make_artifact(
-                'FeatureTable[Frequency]', feature_table)
-
-        if phylogeny:
-            phylogeny = scope.ctx.make_artifact('Phylogeny[Rooted]', phylogeny)
-
-        for depth, i in itertools.product(depth_range, iter_range):
-            rarefy_method = scope.ctx.get_action('feature_table', 'rarefy')
-            rt, = rarefy_method(feature_table, depth)
-
-            for metric in metrics:
-                if metric in (METRICS['PHYLO']['IMPL'] |
-                              METRICS['PHYLO']['UNIMPL']):
-                    alpha_phylo = scope.ctx.get_action('diversity',
-                                                       'alpha_phylogenetic')
-                    vector, = alpha_phylo(table=rt, metric=metric,
-                                          phylogeny=phylogeny)
-                else:
-                    alpha = scope.ctx.get_action('diversity', 'alpha')
-                    vector, = alpha(table=rt, metric=metric)
+    # metrics x samples x depths x iterations; samples that weren't rarefied
+    # at a depth, and iterations that weren't needed, are left as NaN
+    cube = np.full((len(metrics), len(rows), len(depth_range), iterations),
+                   np.nan)
+    metric_positions = {metric: m for m, metric in enumerate(metrics)}
+    shared = (counts, str(phylogeny) if phylogeny else None, metrics)
+
+    # Without a tolerance every iteration is computed in one round. With
+    # one, `min_iterations` are computed first, and then one iteration at a
+    # time is added to each depth that hasn't converged yet.
+    if iteration_tolerance is None:
+        min_iterations = iterations
+    pending = np.arange(len(depth_range))
+    new_iters = range(1, min_iterations + 1)
+    while True:
+        tasks = _rarefaction_tasks(depth_range[pending], new_iters, nested)
+        for results in _parallel_map(_compute_rarefaction_task, shared,
+                                     tasks, min(n_jobs, len(tasks))):
+            for depth, i, vectors in results:
+                # `depth_range` can contain repeated depths when there are
+                # more steps than distinct depths
+                for d in np.flatnonzero(depth_range == depth):
+                    for metric, vector in vectors.items():
+                        cube[metric_positions[metric],
+                             rows.get_indexer(vector.index), d, i - 1] = vector
+
+        done = new_iters[-1]
+        if done == iterations:
+            break
+        pending = np.array([
+            d for d in pending if not _iterations_converged(
+                cube[:, :, d, :done], groupings, iteration_tolerance)],
+            dtype=int)
+        if not len(pending):
+            break
+        new_iters = range(done + 1, done + 2)
+
+    return {metric: pd.DataFrame(cube[m].reshape(len(rows), -1),
+                                 index=rows, columns=cols)
+            for metric, m in metric_positions.items()}
+
+
+def _rarefaction_tasks(depths, iter_range, nested):
+    # A nested task draws every depth of one iteration, otherwise each
+    # (depth, iteration) cell is drawn on its own. Every task gets its own
+    # seed, so results don't depend on how tasks are spread across workers.
+    if nested:
+        tasks = [(depths, i) for i in iter_range]
+    else:
+        tasks = [([depth], i)
+                 for depth, i in itertools.product(depths, iter_range)]
+    seeds = np.random.SeedSequence(
+        np.random.randint(np.iinfo(np.int32).max)).spawn(len(tasks))
+    return [(depths, i, seed) for (depths, i), seed in zip(tasks, seeds)]
+
+
+def _iterations_converged(values, groupings, tolerance):
+    """Whether every group median of every metric has a relative standard
+    error (across iterations) of at most `tolerance`.
+
+    `values` is a metrics x samples x iterations array for a single depth.
+    `groupings` holds an array of per-sample group codes for each metadata
+    column (-1 for missing values), or is None to make every sample its own
+    group.
+    """
+    with warnings.catch_warnings():
+        # groups without any samples at this depth are all-NaN, and ignored
+        warnings.simplefilter('ignore', RuntimeWarning)
+        if groupings is None:
+            medians = values
+        else:
+            medians = np.concatenate(
+                [np.nanmedian(values[:, codes == g], axis=1, keepdims=True)
+                 for codes in groupings for g in range(codes.max() + 1)],
+                axis=1)
 
-                vector = vector.view(pd.Series)
-                data[metric][(depth, i)] = vector
-        return data
+        error = (np.nanstd(medians, axis=2, ddof=1) /
+                 np.sqrt(medians.shape[2]))
+        with np.errstate(divide='ignore', invalid='ignore'):
+            relative = error / np.abs(np.nanmean(medians, axis=2))
+    relative[error == 0] = 0
+    return not (relative > tolerance).any()
 
 
 def alpha_rarefaction(output_dir: str, table: biom.Table, max_depth: int,
                       phylogeny: NewickFormat = None, metrics: set = None,
                       metadata: qiime2.Metadata = None, min_depth: int = 1,
-                      steps: int = 10, iterations: int = 10) -> None:
+                      steps: int = 10, iterations: int = 10,
+                      nested: bool = False, n_jobs: int = 1,
+                      compact: bool = False,
+                      depth_tolerance: float = None,
+                      iteration_tolerance: float = None,
+                      min_iterations: int = 3) -> None:
+    n_jobs = _resolve_n_jobs(n_jobs)
 
     if metrics is None:
         metrics = {'observed_features', 'shannon'}
@@ -341,6 +588,10 @@ def alpha_rarefaction(output_dir: str, table: biom.Table, max_depth: int,
         raise ValueError('Provided number of steps (%d) is greater than the '
                          'steps possible between min_depth and '
                          'max_depth (%d).' % (steps, possible_steps))
+    if iteration_tolerance is not None and min_iterations > iterations:
+        raise ValueError('Provided min_iterations of %d is greater than the '
+                         'provided number of iterations (%d).'
+                         % (min_iterations, iterations))
     if table.is_empty():
         raise ValueError('Provided table is empty.')
     max_frequency = max(table.sum(axis='sample'))
@@ -372,8 +623,33 @@ def alpha_rarefaction(output_dir: str, table: biom.Table, max_depth: int,
             [(c, '') for c in metadata_df.columns])
         columns = metadata_df.columns.get_level_values(0)
 
+    groupings = None
+    if iteration_tolerance is not None and metadata is not None:
+        sample_ids = table.ids(axis='sample')
+        groupings = [pd.factorize(metadata_df[(c, '')].reindex(sample_ids))[0]
+                     for c in columns]
+
     data = _compute_rarefaction_data(table, min_depth, max_depth,
-                                     steps, iterations, phylogeny, metrics)
+                                     steps, iterations, phylogeny, metrics,
+                                     nested=nested, n_jobs=n_jobs,
+                                     depth_tolerance=depth_tolerance,
+                                     iteration_tolerance=iteration_tolerance,
+                                     min_iterations=min_iterations,
+                                     groupings=groupings)
+    if depth_tolerance is not None:
+        steps = len(next(iter(data.values()))
+                    .columns.get_level_values(0).unique())
+
+    plotted_samples = None
+    if (compact and metadata is None and
+            table.shape[1] > _compact_plotted_samples):
+        plotted_samples = np.sort(np.random.choice(
+            table.shape[1], _compact_plotted_samples, replace=False))
+
+    iterations_used = None
+    if iteration_tolerance is not None:
+        iterations_used = 'iterations-used.csv'
+        _alpha_rarefaction_iterations(output_dir, iterations_used, data)
 
     filenames = []
     for m, data in data.items():
@@ -381,7 +657,10 @@ def alpha_rarefaction(output_dir: str, table: biom.Table, max_depth: int,
         filename = '%s.csv' % metric_name
 
         if metadata is None:
-            n_df = _compute_summary(data, 'sample-id')
+            plotted = data
+            if plotted_samples is not None:
+                plotted = data.iloc[plotted_samples]
+            n_df = _compute_summary(plotted, 'sample-id')
             jsonp_filename = '%s.jsonp' % metric_name
             _alpha_rarefaction_jsonp(output_dir, jsonp_filename, metric_name,
                                      n_df, '')
@@ -399,13 +678,11 @@ def alpha_rarefaction(output_dir: str, table: biom.Table, max_depth: int,
                                          metric_name, c_df, column)
                 filenames.append(jsonp_filename)
 
-        with open(os.path.join(output_dir, filename), 'w') as fh:
-            data.columns = [
-                'depth-%d_iter-%d' % (t[0], t[1])
-                for t in data.columns.values]
-            if metadata is not None:
-                data = data.join(metadata.to_dataframe(), how='left')
-            data.to_csv(fh, index_label=['sample-id'])
+        # the compressed archive replaces the much larger CSV
+        if compact:
+            _alpha_rarefaction_npz(output_dir, '%s.npz' % metric_name, data)
+        else:
+            _alpha_rarefaction_csv(output_dir, filename, data, metadata)
 
     index = os.path.join(TEMPLATES, 'alpha_rarefaction_assets', 'index.html')
     q2templates.render(index, output_dir,
@@ -413,7 +690,12 @@ def alpha_rarefaction(output_dir: str, table: biom.Table, max_depth: int,
                                 'filenames': [quote(f) for f in filenames],
                                 'columns': list(columns),
                                 'steps': steps,
-                                'filtered_columns': sorted(filtered_columns)})
+                                'filtered_columns': sorted(filtered_columns),
+                                'plotted_samples': (
+                                    None if plotted_samples is None
+                                    else len(plotted_samples)),
+                                'iterations_used': iterations_used,
+                                'compact': compact})
 
     shutil.copytree(os.path.join(TEMPLATES, 'alpha_rarefaction_assets',
                                  'dist'),
@@ -6,61 +6,119 @@
 # The full license is in the file LICENSE, distributed with this software.
 # ----------------------------------------------------------------------------
 
+import collections.abc
 import pkg_resources
 import os.path
-import functools
+import tempfile
 
 import qiime2
 import biom
+import biom.util
+import numpy as np
+import pandas as pd
 import skbio
+import skbio.stats.ordination
 import seaborn as sns
 import scipy
+import scipy.spatial.distance
 from emperor import Emperor
+import q2_diversity_lib
+from q2_types.feature_table import BIOMV210Format
+from q2_types.tree import NewickFormat
 
 import q2templates
 
 from . import METRICS
-from .._ordination import pcoa
+from .._parallel import _resolve_n_jobs, _parallel_map
+from .._subsample import _DepthSortedCounts, _nested_rarefy
 
 TEMPLATES = pkg_resources.resource_filename('q2_diversity', '_beta')
 
+# Emperor only plots this many axes of an ordination
+_emperor_dimensions = 5
+
+_phylogenetic_metrics = METRICS['PHYLO']['IMPL'] | METRICS['PHYLO']['UNIMPL']
+
 
 def beta_rarefaction(output_dir: str, table: biom.Table, metric: str,
                      clustering_method: str, metadata: qiime2.Metadata,
                      sampling_depth: int, iterations: int = 10,
                      phylogeny: skbio.TreeNode = None,
                      correlation_method: str = 'spearman',
-                     color_scheme: str = 'BrBG') -> None:
-    with qiime2.sdk.Context() as scope:
-        if table.is_empty():
-            raise ValueError("Input feature table is empty.")
-
-        # Filter metadata to only include sample IDs present in the feature
-        # table. Also ensures every feature table sample ID is present in the
-        # metadata.
-        metadata = metadata.filter_ids(table.ids(axis='sample'))
-
-        table = qiime2.Artifact.import_data('FeatureTable[Frequency]', table)
-
-        if metric in METRICS['PHYLO']['IMPL'] | METRICS['PHYLO']['UNIMPL']:
-            if phylogeny is None:
-                raise ValueError("A phylogenetic metric (%s) was requested, "
-                                 "but a phylogenetic tree was not provided. "
-                                 "Phylogeny must be provided when using a "
-                                 "phylogenetic diversity metric." % metric)
-
-            phylogeny = qiime2.Artifact.import_data('Phylogeny[Rooted]',
-                                                    phylogeny)
-            api_method = scope.ctx.get_action('diversity', 'beta_phylogenetic')
-            beta_func = functools.partial(api_method, phylogeny=phylogeny)
-        else:
-            beta_func = scope.ctx.get_action('diversity', 'beta')
-
-        rare_func = scope.ctx.get_action('feature-table', 'rarefy')
-
-        distance_matrices = _get_multiple_rarefaction(
-            beta_func, rare_func, metric, iterations, table, sampling_depth)
+                     color_scheme: str = 'BrBG', n_jobs: int = 1,
+                     pcoa_dimensions: int = None,
+                     metrics: set = None) -> None:
+    n_jobs = _resolve_n_jobs(n_jobs)
+
+    metrics = sorted({metric} | set(metrics or ()))
+
+    if table.is_empty():
+        raise ValueError("Input feature table is empty.")
+
+    # Filter metadata to only include sample IDs present in the feature
+    # table. Also ensures every feature table sample ID is present in the
+    # metadata.
+    metadata = metadata.filter_ids(table.ids(axis='sample'))
+
+    phylo_metrics = [m for m in metrics if m in _phylogenetic_metrics]
+    if phylo_metrics:
+        if phylogeny is None:
+            raise ValueError("A phylogenetic metric (%s) was requested, "
+                             "but a phylogenetic tree was not provided. "
+                             "Phylogeny must be provided when using a "
+                             "phylogenetic diversity metric."
+                             % ', '.join(phylo_metrics))
+    else:
+        phylogeny = None
+
+    distance_matrices = _get_multiple_rarefaction(
+        table, metrics, iterations, sampling_depth, phylogeny=phylogeny,
+        n_jobs=n_jobs)
 
+    templates = list(map(
+        lambda page: os.path.join(TEMPLATES, 'beta_rarefaction_assets', page),
+        ['index.html', 'heatmap.html', 'tree.html', 'emperor.html']))
+    pages = [('emperor.html', 'PCoA'), ('heatmap.html', 'Heatmap'),
+             ('tree.html', 'Clustering')]
+
+    if len(metrics) == 1:
+        metric, = metrics
+        _beta_rarefaction_outputs(
+            output_dir, metric, distance_matrices[metric], clustering_method,
+            metadata, correlation_method, color_scheme, n_jobs,
+            pcoa_dimensions)
+        context = {
+            'metric': metric,
+            'clustering_method': clustering_method,
+            'tabs': [{'url': url, 'title': title} for url, title in pages]
+        }
+        q2templates.render(templates, output_dir, context=context)
+        return
+
+    # Each metric's outputs and pages go in a directory of their own, with
+    # one set of tabs per metric.
+    tabs = [{'url': '%s/%s' % (metric, url),
+             'title': '%s (%s)' % (title, metric)}
+            for metric in metrics for url, title in pages]
+    for metric in metrics:
+        metric_dir = os.path.join(output_dir, metric)
+        os.mkdir(metric_dir)
+        _beta_rarefaction_outputs(
+            metric_dir, metric, distance_matrices.pop(metric),
+            clustering_method, metadata, correlation_method, color_scheme,
+            n_jobs, pcoa_dimensions)
+        context = {
+            'metric': metric,
+            'clustering_method': clustering_method,
+            'tabs': [dict(tab, url='../' + tab['url']) for tab in tabs]
+        }
+        q2templates.render(templates[1:], metric_dir, context=context)
+    q2templates.render(templates[:1], output_dir, context={'tabs': tabs})
+
+
+def _beta_rarefaction_outputs(output_dir, metric, distance_matrices,
+                              clustering_method, metadata, correlation_method,
+                              color_scheme, n_jobs, pcoa_dimensions):
     primary = distance_matrices[0]
     support = distance_matrices[1:]
 
@@ -71,50 +129,197 @@ def beta_rarefaction(output_dir: str, table: biom.Table, metric: str,
         os.path.join(output_dir, 'rarefaction-iteration-correlation.tsv'),
         sep='\t')
 
-    tree = _cluster_samples(primary, support, clustering_method)
+    tree = _cluster_samples(primary, support, clustering_method,
+                            n_jobs=n_jobs)
     tree.write(os.path.join(output_dir,
                             'sample-clustering-%s.tre' % clustering_method))
 
-    emperor = _jackknifed_emperor(primary, support, metadata)
+    emperor = _jackknifed_emperor(primary, support, metadata, n_jobs=n_jobs,
+                                  pcoa_dimensions=pcoa_dimensions)
     emperor_dir = os.path.join(output_dir, 'emperor')
     emperor.copy_support_files(emperor_dir)
     with open(os.path.join(emperor_dir, 'index.html'), 'w') as fh:
         fh.write(emperor.make_emperor(standalone=True))
 
-    templates = list(map(
-        lambda page: os.path.join(TEMPLATES, 'beta_rarefaction_assets', page),
-        ['index.html', 'heatmap.html', 'tree.html', 'emperor.html']))
 
-    context = {
-        'metric': metric,
-        'clustering_method': clustering_method,
-        'tabs': [{'url': 'emperor.html',
-                  'title': 'PCoA'},
-                 {'url': 'heatmap.html',
-                  'title': 'Heatmap'},
-                 {'url': 'tree.html',
-                  'title': 'Clustering'}]
-    }
-
-    q2templates.render(templates, output_dir, context=context)
-
-
-def _get_multiple_rarefaction(beta_func, rare_func, metric, iterations, table,
-                              sampling_depth):
-    distance_matrices = []
-    for _ in range(iterations):
-        rarefied_table, = rare_func(table=table, sampling_depth=sampling_depth)
-        distance_matrix, = beta_func(table=rarefied_table, metric=metric)
-        distance_matrices.append(distance_matrix.view(skbio.DistanceMatrix))
+def _get_multiple_rarefaction(table, metrics, iterations, sampling_depth,
+                              phylogeny=None, n_jobs=1):
+    """Rarefy `table` `iterations` times, and compute each of `metrics` from
+    every rarefied table.
+
+    Returns a dict mapping each metric to a `_DistanceMatrixStack` of its
+    distance matrices, in the order of the iterations.
+    """
+    counts = _DepthSortedCounts(table)
+    if counts.eligible(sampling_depth) == 0:
+        raise ValueError('The rarefied table contains no samples or '
+                         'features. Verify your table is valid and that you '
+                         'provided a shallow enough sampling depth.')
+
+    if phylogeny is not None:
+        # the tree is handed to the workers as a file rather than pickled
+        phylogeny_fp = NewickFormat()
+        phylogeny.write(str(phylogeny_fp))
+        phylogeny = str(phylogeny_fp)
+
+    # Iterations are spread over up to `n_jobs` worker processes, and any
+    # cores left over are handed to the metric itself.
+    workers = min(n_jobs, iterations)
+    threads = max(1, n_jobs // workers)
+
+    # Every iteration gets its own seed, so results don't depend on how the
+    # iterations are spread across workers.
+    seeds = np.random.SeedSequence(
+        np.random.randint(np.iinfo(np.int32).max)).spawn(iterations)
+
+    # Each worker writes its distance matrices into the (memory-mapped)
+    # stacks itself, so only their condensed single precision forms are ever
+    # held, rather than every worker's square matrices being sent back. The
+    # rarefied tables keep the samples that are deep enough, in the table's
+    # order.
+    ids = counts.sample_ids[
+        np.sort(counts.order[:counts.eligible(sampling_depth)])].tolist()
+    distance_matrices = {metric: _DistanceMatrixStack(ids, iterations)
+                         for metric in metrics}
+    shared = (counts, phylogeny, distance_matrices, sampling_depth, threads)
+    for _ in _parallel_map(_rarefied_beta_task, shared,
+                           list(enumerate(seeds)), workers):
+        pass
     return distance_matrices
 
 
+class _DistanceMatrixStack(collections.abc.Sequence):
+    """A sequence of distance matrices over the same IDs, stored as the rows
+    of a temporary memory-mapped array of single precision condensed forms.
+
+    Square matrices are only materialized when indexed, so iterating over the
+    stack holds one matrix in memory at a time however many there are, and
+    code that only needs condensed forms can read `condensed` directly. Slicing
+    returns a stack sharing the same storage, and a pickled stack (e.g. one
+    sent to a worker process) maps the same file rather than carrying a copy
+    of the matrices, so that matrices set in the worker are seen by the
+    original stack.
+    """
+
+    dtype = np.float32
+
+    def __init__(self, ids, n_matrices):
+        self.ids = tuple(ids)
+        n_pairs = len(self.ids) * (len(self.ids) - 1) // 2
+        self._shape = (n_matrices, n_pairs)
+        self._rows = range(n_matrices)
+        if n_matrices and n_pairs:
+            # removed once the stack (and any slices of it) are collected
+            self._file = tempfile.NamedTemporaryFile(prefix='q2-diversity-')
+            self.condensed = np.memmap(self._file.name, dtype=self.dtype,
+                                       mode='w+', shape=self._shape)
+        else:
+            # arrays without any elements can't be memory-mapped
+            self._file = None
+            self.condensed = np.empty(self._shape, dtype=self.dtype)
+
+    def __len__(self):
+        return len(self._rows)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            view = object.__new__(_DistanceMatrixStack)
+            view.__dict__.update(self.__dict__, _rows=self._rows[index],
+                                 condensed=self.condensed[index])
+            return view
+        return skbio.DistanceMatrix(
+            scipy.spatial.distance.squareform(self.condensed[index],
+                                              checks=False), self.ids)
+
+    def __setitem__(self, index, dm):
+        if dm.ids != self.ids:
+            if set(dm.ids) != set(self.ids):
+                raise ValueError("IDs exist that are not in both distance "
+                                 "matrices.")
+            dm = dm.filter(self.ids)
+        self.condensed[index] = dm.condensed_form()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        if self._file is not None:
+            # the receiving process doesn't own the file, which is removed
+            # with the original stack
+            state['_file'] = None
+            state['condensed'] = self._file.name
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if isinstance(self.condensed, str):
+            rows = self._rows
+            self.condensed = np.memmap(
+                self.condensed, dtype=self.dtype, mode='r+',
+                shape=self._shape)[rows.start:rows.stop:rows.step]
+
+
+def _as_stack(distance_matrices):
+    if (isinstance(distance_matrices, _DistanceMatrixStack) or
+            not distance_matrices):
+        return distance_matrices
+    stack = _DistanceMatrixStack(distance_matrices[0].ids,
+                                 len(distance_matrices))
+    for i, dm in enumerate(distance_matrices):
+        stack[i] = dm
+    return stack
+
+
+def _temporary_array(shape):
+    # An anonymous temporary file, removed once the array is garbage
+    # collected. Arrays without any elements can't be memory-mapped.
+    if 0 in shape:
+        return np.empty(shape)
+    return np.memmap(tempfile.TemporaryFile(), dtype=float, mode='w+',
+                     shape=shape)
+
+
+def _rarefied_beta_task(shared, task):
+    counts, phylogeny, distance_matrices, sampling_depth, threads = shared
+    iteration, seed = task
+
+    (_, rarefied), = _nested_rarefy(counts, [sampling_depth],
+                                    np.random.default_rng(seed))
+    if phylogeny is not None:
+        phylogeny = NewickFormat(phylogeny, mode='r')
+    # the phylogenetic metrics read the table from a BIOM v2.1 file, which is
+    # written at most once per iteration and shared by those metrics
+    table_fp = None
+    for metric, stack in distance_matrices.items():
+        if metric in _phylogenetic_metrics and table_fp is None:
+            table_fp = BIOMV210Format()
+            with biom.util.biom_open(str(table_fp), 'w') as fh:
+                rarefied.to_hdf5(fh, generated_by='q2-diversity')
+        stack[iteration] = _compute_beta(rarefied, table_fp, phylogeny,
+                                         metric, threads)
+
+
+def _compute_beta(table, table_fp, phylogeny, metric, threads):
+    if metric in _phylogenetic_metrics:
+        if metric in METRICS['PHYLO']['IMPL']:
+            function = getattr(q2_diversity_lib,
+                               METRICS['NAME_TRANSLATIONS'][metric])
+            return function(table=table_fp, phylogeny=phylogeny,
+                            threads=threads)
+        return q2_diversity_lib.beta_phylogenetic_passthrough(
+            table=table_fp, phylogeny=phylogeny, metric=metric,
+            threads=threads)
+    elif metric in METRICS['NONPHYLO']['IMPL']:
+        function = getattr(q2_diversity_lib,
+                           METRICS['NAME_TRANSLATIONS'][metric])
+        return function(table=table, n_jobs=threads)
+    else:
+        return q2_diversity_lib.beta_passthrough(table=table, metric=metric,
+                                                 n_jobs=threads)
+
+
 def _make_heatmap(distance_matrices, metric, correlation_method, color_scheme):
     test_statistics = {'spearman': "Spearman's rho", 'pearson': "Pearson's r"}
 
-    sm_df = skbio.stats.distance.pwmantel(
-        distance_matrices, method=correlation_method, permutations=0,
-        strict=True)
+    sm_df = _pairwise_mantel(distance_matrices, correlation_method)
     sm = sm_df[['statistic']]  # Drop all other DF columns
     sm = sm.unstack(level=0)  # Reshape for seaborn
 
@@ -129,18 +334,87 @@ def _make_heatmap(distance_matrices, metric, correlation_method, color_scheme):
     return ax.get_figure(), sm_df
 
 
-def _cluster_samples(primary, support, clustering_method):
+def _pairwise_mantel(distance_matrices, method):
+    """Mantel statistics between every pair of `distance_matrices`.
+
+    Equivalent to ``skbio.stats.distance.pwmantel`` with ``permutations=0``
+    and ``strict=True``, and returns a DataFrame in the same format, but
+    computes all of the statistics at once: the condensed forms are stacked
+    into one (matrices x pairs) array, ranked once per matrix for Spearman,
+    and correlated with a single pass of matrix products.
+    """
+    distance_matrices = _as_stack(distance_matrices)
+    if len(distance_matrices.ids) < 3:
+        raise ValueError("Distance matrices must be at least 3x3 in size.")
+
+    condensed = distance_matrices.condensed
+    if method == 'spearman':
+        ranked = _temporary_array(condensed.shape)
+        for i, row in enumerate(condensed):
+            ranked[i] = _average_ranks(row)
+        condensed = ranked
+    statistics = _row_correlations(condensed)
+
+    dm1, dm2 = np.triu_indices(len(distance_matrices), k=1)
+    return pd.DataFrame(
+        {'statistic': statistics[dm1, dm2], 'p-value': np.nan,
+         'n': len(distance_matrices.ids), 'method': method,
+         'permutations': 0, 'alternative': 'two-sided'},
+        index=pd.MultiIndex.from_arrays([dm1, dm2], names=['dm1', 'dm2']))
+
+
+def _row_correlations(rows, block_size=2 ** 23):
+    """Pearson correlation between every pair of `rows`, like
+    ``np.corrcoef(rows)``.
+
+    `rows` is read in blocks of about `block_size` elements, so a
+    memory-mapped array is never loaded into memory all at once.
+    """
+    n_rows, n_columns = rows.shape
+    step = max(1, block_size // n_rows)
+    means = rows.mean(axis=1, dtype=float, keepdims=True)
+    products = np.zeros((n_rows, n_rows))
+    for start in range(0, n_columns, step):
+        block = rows[:, start:start + step] - means
+        products += block @ block.T
+
+    norms = np.sqrt(np.diag(products))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.clip(products / np.outer(norms, norms), -1.0, 1.0)
+
+
+def _average_ranks(values):
+    # scipy.stats.rankdata(values, method='average'), which is much slower
+    # when applied along an axis of a 2D array
+    order = np.argsort(values)
+    ordered = values[order]
+    first = np.concatenate([[True], ordered[1:] != ordered[:-1]])
+    tie_group = np.cumsum(first) - 1
+    bounds = np.append(np.flatnonzero(first), len(values))
+    ranks = np.empty(len(values))
+    ranks[order] = (bounds[tie_group] + bounds[tie_group + 1] + 1) / 2
+    return ranks
+
+
+def _cluster_samples(primary, support, clustering_method, n_jobs=1):
     cluster = {'nj': _nj, 'upgma': _upgma}[clustering_method]
 
     primary = cluster(primary)
     primary_internal_nodes = list(primary.non_tips())
+    support = _as_stack(support)
     support_total = len(support)
 
     for n in primary_internal_nodes:
         n.support_count = 0
 
-    for dm in support:
-        _add_support_count(primary_internal_nodes, cluster(dm))
+    # The support trees are built in parallel, and only their clades (as tip
+    # bitmasks, see _clade_masks) are sent back.
+    tip_index = {}
+    masks = _clade_masks(primary, tip_index)
+    for support_clades in _parallel_map(
+            _support_clades, (support, clustering_method, tip_index),
+            range(support_total), n_jobs):
+        _add_support_count(primary_internal_nodes, masks, support_clades)
 
     for n in primary_internal_nodes:
         n.name = str(n.support_count / support_total)
@@ -149,9 +423,27 @@ def _cluster_samples(primary, support, clustering_method):
     return primary
 
 
+def _support_clades(shared, index):
+    support, clustering_method, tip_index = shared
+    if clustering_method == 'upgma':
+        # UPGMA only needs the condensed form, and the clades can be read
+        # off the linkage matrix without building a tree
+        linkage = scipy.cluster.hierarchy.average(support.condensed[index])
+        return _linkage_clades(linkage, support.ids, tip_index)
+    return set(_clade_masks(_nj(support[index]), tip_index).values())
+
+
+def _linkage_clades(linkage, ids, tip_index):
+    """The tip bitmasks (see _clade_masks) of every clade of the tree that
+    ``skbio.TreeNode.from_linkage_matrix(linkage, ids)`` would build."""
+    masks = [1 << tip_index[id_] for id_ in ids]
+    for first, second in linkage[:, :2].astype(int):
+        masks.append(masks[first] | masks[second])
+    return set(masks)
+
+
 def _upgma(dm):
-    upper_triangle = dm.condensed_form()
-    linkage = scipy.cluster.hierarchy.average(upper_triangle)
+    linkage = scipy.cluster.hierarchy.average(dm.condensed_form())
     tree = skbio.TreeNode.from_linkage_matrix(linkage, dm.ids)
     tree.name = "root"  # root_at_midpoint for _nj labels the root
     return tree
@@ -160,24 +452,264 @@ def _upgma(dm):
 def _nj(dm):
     # Negative branch lengths are strange, BUT we are clustering, not modeling
     # evolution, so it's not necessarily a problem
-    nj = skbio.tree.nj(dm, disallow_negative_branch_length=False)
+    nj = _neighbor_join(dm.data, dm.ids)
     return nj.root_at_midpoint()
 
 
-def _add_support_count(nodes, support):
-    # This isn't a fast or really good way to compute this, but it is obvious.
+def _neighbor_join(distances, ids):
+    """Neighbor joining, as ``skbio.tree.nj`` (of scikit-bio 0.5) with
+    ``disallow_negative_branch_length=False``.
+
+    The same pairs are joined in the same order, and ties are broken the
+    same way: each node keeps its position in scikit-bio's reduced distance
+    matrix (where the newest node is first), and ties are broken by
+    position. The distance matrix isn't reduced, though. The joined node's
+    distances overwrite one of the pair's row and column, the last active
+    row and column are moved into the other's, and the row sums are updated
+    rather than recomputed, so Q values that only tie up to rounding (e.g.
+    for duplicate samples) can be broken differently. The pair to join is
+    found as in RapidNJ (see _nj_pair). The tree is built directly rather
+    than through Newick strings, so branch lengths are not rounded to six
+    decimal places.
+    """
+    if len(ids) < 3:
+        raise ValueError("Distance matrix must be at least 3x3 to "
+                         "generate a neighbor joining tree.")
+    distances = np.array(distances, dtype=float)
+    num_tips = len(ids)
+    row_sums = distances.sum(axis=1)
+    positions = np.arange(num_tips)
+    nodes = [skbio.TreeNode(name=id_) for id_ in ids]
+
+    # Each row's distances to the other nodes when the row was written, in
+    # increasing order, and the (numbered) nodes they are to. Tips are nodes
+    # 0 to num_tips - 1 and joined nodes are numbered from num_tips on. A
+    # node's row is `rows[node]`, or -1 once it is joined, and the last
+    # number is a node that never has a row, for the unused entries.
+    np.fill_diagonal(distances, np.inf)
+    order = np.argsort(distances, axis=1, kind='stable')
+    sorted_distances = np.take_along_axis(distances, order, axis=1)
+    np.fill_diagonal(distances, 0)
+    partners = order.astype(np.int32)
+    partners[:, -1] = 2 * num_tips - 1
+    starts = np.zeros(num_tips, dtype=int)
+    rows = np.full(2 * num_tips, -1)
+    rows[:num_tips] = np.arange(num_tips)
+    numbers = np.arange(num_tips)
+
+    # only the first `active` rows and columns are in use
+    for active in range(num_tips, 3, -1):
+        if active == 4:
+            # With four nodes, the pairs of the Q matrix tie two by two, and
+            # rounding decides which is joined, so the row sums are summed
+            # in scikit-bio's order.
+            order = np.argsort(positions[:4])
+            row_sums[order] = distances[np.ix_(order, order)].sum(axis=1)
+        first, second = _nj_pair(active, row_sums, sorted_distances,
+                                 partners, starts, rows, positions)
+        _nj_branch_lengths(distances, row_sums, active, nodes, first, second)
+        joined = 0.5 * (distances[first, :active] +
+                        distances[second, :active] - distances[first, second])
+        joined[[first, second]] = 0
+        row_sums[:active] += (joined - distances[first, :active] -
+                              distances[second, :active])
+        row_sums[second] = joined.sum()
+        distances[second, :active] = distances[:active, second] = joined
+        nodes[second] = skbio.TreeNode(children=[nodes[first],
+                                                 nodes[second]])
+        # the joined node comes first, and the others keep their order
+        positions[:active] += 1 - (
+            (positions[:active] > positions[first]).astype(int) +
+            (positions[:active] > positions[second]))
+        positions[second] = 0
+
+        rows[numbers[[first, second]]] = -1
+        numbers[second] = 2 * num_tips - active
+        rows[numbers[second]] = second
+        others = np.delete(np.arange(active), [first, second])
+        order = np.argsort(joined[others], kind='stable')
+        sorted_distances[second, :len(others)] = joined[others[order]]
+        sorted_distances[second, len(others):] = np.inf
+        partners[second, :len(others)] = numbers[others[order]]
+        partners[second, len(others):] = 2 * num_tips - 1
+        starts[second] = 0
+
+        last = active - 1
+        if first != last:
+            distances[first, :last] = distances[last, :last]
+            distances[:last, first] = distances[:last, last]
+            distances[first, first] = 0
+            row_sums[first] = row_sums[last]
+            positions[first] = positions[last]
+            nodes[first] = nodes[last]
+            sorted_distances[first] = sorted_distances[last]
+            partners[first] = partners[last]
+            starts[first] = starts[last]
+            numbers[first] = numbers[last]
+            rows[numbers[first]] = first
+
+    # the last three nodes are joined at the root
+    order = np.argsort(positions[:3])
+    nodes = [nodes[i] for i in order]
+    distances = distances[np.ix_(order, order)]
+    _nj_branch_lengths(distances, distances.sum(axis=1), 3, nodes, 1, 2)
+    nodes[0].length = 0.5 * (distances[0, 1] + distances[0, 2] -
+                             distances[1, 2])
+    return skbio.TreeNode(children=[nodes[1], nodes[0], nodes[2]])
+
+
+def _nj_pair(active, row_sums, sorted_distances, partners, starts, rows,
+             positions, chunk_size=8):
+    """The rows ``(i, j)`` of the next pair of nodes to join, with ``i``
+    after ``j`` in `positions`: the minimum of the Q matrix, with ties broken
+    as in scikit-bio.
+
+    As in RapidNJ (Simonsen et al., 2008), each row's Q values are computed
+    in increasing order of distance, and only while they can be at most the
+    smallest Q value found: a row's remaining Q values are bounded below by
+    its next distance and the largest row sum. Every pair is in the sorted
+    row of its newer node, as that row was written after the older node's.
+    This is exact, rounding included, as the bound is rounded the same way
+    as the Q values.
+    """
+    row_sums = row_sums[:active]
+    largest_sum = row_sums.max()
+    width = sorted_distances.shape[1]
+    best = np.inf
+    candidates = []
+    scanned = np.arange(active)
+    columns = starts[:active, np.newaxis] + np.arange(chunk_size)
+    while len(scanned):
+        columns = np.minimum(columns, width - 1)
+        partner_rows = rows[partners[scanned[:, np.newaxis], columns]]
+        q = ((active - 2) * sorted_distances[scanned[:, np.newaxis], columns] -
+             (row_sums[scanned, np.newaxis] + row_sums[partner_rows]))
+        joined = partner_rows < 0
+        q[joined] = np.inf
+        if len(columns[0]) == chunk_size:
+            # the nodes a row starts with that were joined stay joined, and
+            # are skipped from now on
+            skipped = np.where(joined.all(axis=1), chunk_size,
+                               np.argmin(joined, axis=1))
+            starts[:active] = np.minimum(columns[:, 0] + skipped, width - 1)
+        chunk_best = q.min()
+        if chunk_best < best:
+            best = chunk_best
+            candidates = []
+        if chunk_best == best:
+            found = np.argwhere(q == best)
+            candidates.append(np.column_stack([
+                scanned[found[:, 0]], partner_rows[tuple(found.T)]]))
+        next_columns = np.minimum(columns[:, -1] + 1, width - 1)
+        more = ((active - 2) * sorted_distances[scanned, next_columns] -
+                (row_sums[scanned] + largest_sum)) <= best
+        scanned = scanned[more]
+        columns = (next_columns[more, np.newaxis] +
+                   np.arange(2 * columns.shape[1]))
+    # a pair of tips is found in both of their rows, in either order
+    candidates = np.concatenate(candidates)
+    candidates = np.unique(np.where(
+        (positions[candidates[:, 0]] > positions[candidates[:, 1]])[:, None],
+        candidates, candidates[:, ::-1]), axis=0)
+
+    # scikit-bio takes the tied pair nearest to (0, 0) of its Q matrix, and
+    # of those the one with the largest i
+    i, j = positions[candidates[:, 0]], positions[candidates[:, 1]]
+    radii = np.sqrt(i ** 2 + j ** 2)
+    nearest = candidates[radii == radii.min()]
+    return tuple(nearest[np.argmax(positions[nearest[:, 0]])])
+
+
+def _nj_branch_lengths(distances, row_sums, n, nodes, first, second):
+    first_to_second = distances[first, second]
+    first_to_new = (0.5 * first_to_second +
+                    ((row_sums[first] - row_sums[second]) / (2 * (n - 2))))
+    nodes[first].length = first_to_new
+    nodes[second].length = first_to_second - first_to_new
+
+
+def _add_support_count(nodes, masks, support_clades):
+    # Every clade of both trees is encoded once as a bitmask of its tips (see
+    # _clade_masks), so a node is supported if its mask is among the support
+    # tree's clades: the support tree has a subtree with exactly the same tips
+    # (though the subtree's topology may differ).
     for n in nodes:
-        n_tips = {t.name for t in n.tips()}
-        corresponding_node = support.lca(n_tips)
-        if {t.name for t in corresponding_node.tips()} == n_tips:
-            # This node has the same tips as the lca of the support tree with
-            # the same tips, so there aren't any missing or extra nodes in the
-            # support's subtree. (Though the subtree's topology may differ.)
+        if masks[id(n)] in support_clades:
             n.support_count += 1
 
 
-def _jackknifed_emperor(primary_matrix, support_matrices, metadata):
-    primary_pcoa = pcoa(primary_matrix)
-    jackknifed_pcoa = list(map(pcoa, support_matrices))
+def _clade_masks(tree, tip_index):
+    """Map the id of every node in `tree` to a bitmask of the tips below it.
+
+    `tip_index` maps tip names to bit positions, and is extended with any
+    tips it doesn't have yet, so that masks from different trees sharing it
+    can be compared.
+    """
+    masks = {}
+    for node in tree.postorder(include_self=True):
+        if node.is_tip():
+            mask = 1 << tip_index.setdefault(node.name, len(tip_index))
+        else:
+            mask = 0
+            for child in node.children:
+                mask |= masks[id(child)]
+        masks[id(node)] = mask
+    return masks
+
+
+def _jackknifed_emperor(primary_matrix, support_matrices, metadata,
+                        n_jobs=1, pcoa_dimensions=None):
+    if pcoa_dimensions is not None:
+        pcoa_dimensions = min(pcoa_dimensions, len(primary_matrix.ids))
+    # Only the plotted axes are kept, so that the ordination of each
+    # iteration takes n_samples x 5 rather than n_samples ** 2 values.
+    primary_pcoa = _plotted_axes(_pcoa(primary_matrix, pcoa_dimensions))
+    jackknifed_pcoa = list(_parallel_map(
+        _plotted_pcoa,
+        (support_matrices, pcoa_dimensions, primary_pcoa.samples),
+        range(len(support_matrices)), n_jobs))
     df = metadata.to_dataframe()
     return Emperor(primary_pcoa, df, jackknifed=jackknifed_pcoa, remote='.')
+
+
+def _plotted_pcoa(shared, index):
+    distance_matrices, dimensions, primary_samples = shared
+    ordination = _plotted_axes(_pcoa(distance_matrices[index], dimensions))
+    ordination.samples = _align_axes(ordination.samples, primary_samples)
+    return ordination
+
+
+def _pcoa(distance_matrix, dimensions):
+    # As the pcoa action, but never centering `distance_matrix` in place, as
+    # the matrices here belong to the caller (or are shared with workers).
+    if dimensions is None:
+        return skbio.stats.ordination.pcoa(distance_matrix, method='eigh',
+                                           inplace=False)
+    return skbio.stats.ordination.pcoa(
+        distance_matrix, method='fsvd', number_of_dimensions=dimensions,
+        inplace=False)
+
+
+def _plotted_axes(ordination):
+    return skbio.OrdinationResults(
+        ordination.short_method_name, ordination.long_method_name,
+        ordination.eigvals[:_emperor_dimensions],
+        samples=ordination.samples.iloc[:, :_emperor_dimensions],
+        proportion_explained=ordination.proportion_explained[
+            :_emperor_dimensions])
+
+
+def _align_axes(samples, reference):
+    """Flip the sign of each axis of `samples` that points away from the
+    same axis of `reference`.
+
+    Eigenvectors are only defined up to their sign, so without this an axis
+    of a replicate can be mirrored relative to the primary ordination.
+    """
+    shared = min(samples.shape[1], reference.shape[1])
+    agreement = np.einsum(
+        'ij,ij->j', samples.values[:, :shared],
+        reference.loc[samples.index].values[:, :shared])
+    signs = np.ones(samples.shape[1])
+    signs[:shared][agreement < 0] = -1
+    return samples * signs
@@ -0,0 +1,164 @@
+# ----------------------------------------------------------------------------
+# Copyright (c) 2016-2021, QIIME 2 development team.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# ----------------------------------------------------------------------------
+
+import numpy as np
+import pandas as pd
+import scipy.sparse
+
+from .._parallel import _SharedArray
+from .._permutation import _monte_carlo_p_value
+
+# the approximate number of bytes of working memory for a batch of
+# permutations, which sets the number of permutations in a batch
+_memory_budget = 2 ** 26
+
+# the number of permutations in the first batch of a sequential test, with
+# each later batch twice as large as the last until the memory budget is
+# reached
+_first_batch_size = 100
+
+# with at least this many groups, the indicator matrices are sparse, as the
+# cost of a sparse product doesn't grow with the number of groups
+_sparse_groups = 16
+
+
+class _Permanova:
+    """PERMANOVA of a distance matrix against a grouping, and against any
+    subset of the grouping's groups.
+
+    The distances are squared once, and every test (the test across all
+    groups, and e.g. each pairwise test) reuses them. Within a test, the
+    pseudo-F statistics of a batch of permutations are evaluated together, as
+    a product of the squared distances with the stacked group indicator
+    matrices of the batch. Batches are at most as large as `_memory_budget`
+    allows, so that e.g. 99,999 permutations run in a bounded amount of
+    memory.
+
+    The squared distances are a `_SharedArray`, so an instance can be handed
+    to worker processes to run tests in parallel. Results are in the format
+    of ``skbio.stats.distance.permanova``.
+    """
+
+    def __init__(self, distance_matrix, grouping):
+        grouping = grouping[list(distance_matrix.ids)]
+        self.squared = _SharedArray(distance_matrix.data ** 2)
+        self.codes, self.groups = pd.factorize(grouping.values)
+        self.positions = {group: np.flatnonzero(self.codes == code)
+                          for code, group in enumerate(self.groups)}
+
+    def test(self, groups=None, permutations=999, rng=None,
+             exceedances=None):
+        """Test for a difference between `groups` (by default, all of the
+        groups) with `permutations` permutations of their samples' labels.
+
+        If `exceedances` is given, the test stops early once that many
+        permutations were at least as extreme as the observed grouping (see
+        `_monte_carlo_p_value`), and the number of permutations in the
+        results is the number that were run.
+        """
+        if rng is None:
+            # seeded from the global random state, so that np.random.seed
+            # makes the test reproducible, as it does scikit-bio's
+            rng = np.random.default_rng(
+                np.random.randint(np.iinfo(np.int32).max))
+        if groups is None:
+            squared = self.squared.array
+            labels = self.codes
+        else:
+            positions = [self.positions[group] for group in groups]
+            samples = np.concatenate(positions)
+            squared = self.squared.array[np.ix_(samples, samples)]
+            labels = np.repeat(np.arange(len(groups)),
+                               [len(p) for p in positions])
+
+        sample_size = len(labels)
+        group_sizes = np.bincount(labels)
+        num_groups = len(group_sizes)
+        if num_groups == sample_size:
+            raise ValueError(
+                "All values in the grouping vector are unique. This method "
+                "cannot operate on a grouping vector with only unique values "
+                "(e.g., there are no 'within' distances because each group "
+                "of objects contains only a single object).")
+        if num_groups == 1:
+            raise ValueError(
+                "All values in the grouping vector are the same. This method "
+                "cannot operate on a grouping vector with only a single group "
+                "of objects (e.g., there are no 'between' distances because "
+                "there is only a single group).")
+
+        # the total sum of squares doesn't depend on the grouping
+        s_T = squared.sum() / sample_size / 2
+        stat, = _pseudo_f(squared, labels[np.newaxis], group_sizes, s_T)
+        batch_size = max(1, _memory_budget // _bytes_per_permutation(
+            sample_size, num_groups))
+
+        def exceeded():
+            # for a sequential test, batches start small and grow, so that a
+            # test that stops early doesn't run many more permutations than
+            # it needs
+            done = 0
+            size = batch_size if exceedances is None else _first_batch_size
+            while done < permutations:
+                size = min(size, batch_size, permutations - done)
+                batch = rng.permuted(
+                    np.broadcast_to(labels, (size, sample_size)), axis=1)
+                stats = _pseudo_f(squared, batch, group_sizes, s_T)
+                # permutations that tie with the observed statistic are
+                # counted, even if the summation order changed its last bits
+                yield (stats >= stat) | np.isclose(stats, stat, rtol=1e-10,
+                                                   atol=0)
+                done += size
+                size *= 2
+
+        p_value, permutations = _monte_carlo_p_value(exceeded(), exceedances)
+
+        return pd.Series(
+            data=['PERMANOVA', 'pseudo-F', sample_size, num_groups, stat,
+                  p_value, permutations],
+            index=['method name', 'test statistic name', 'sample size',
+                   'number of groups', 'test statistic', 'p-value',
+                   'number of permutations'],
+            name='PERMANOVA results')
+
+
+def _bytes_per_permutation(sample_size, num_groups):
+    if num_groups < _sparse_groups:
+        # the indicator matrix and its product with the squared distances
+        return 2 * sample_size * num_groups * 8
+    # the product, plus the indicator matrix and the indices into it
+    return sample_size * (num_groups + 4) * 8
+
+
+def _pseudo_f(squared, labels, group_sizes, s_T):
+    """The pseudo-F statistic of each row of `labels`."""
+    num_labellings, sample_size = labels.shape
+    num_groups = len(group_sizes)
+
+    # the group indicator matrices of the labellings, side by side
+    samples = np.tile(np.arange(sample_size), num_labellings)
+    columns = (labels + num_groups *
+               np.arange(num_labellings)[:, np.newaxis]).ravel()
+    # twice the sum of the squared distances within each group
+    if num_groups < _sparse_groups:
+        indicators = np.zeros((sample_size, num_labellings * num_groups))
+        indicators[samples, columns] = 1
+        within = np.einsum('ij,ij->j', indicators, squared @ indicators)
+    else:
+        indicators = scipy.sparse.csr_matrix(
+            (np.ones(len(samples)), (columns, samples)),
+            shape=(num_labellings * num_groups, sample_size))
+        # each sample's summed squared distance to each group
+        to_groups = indicators @ squared
+        within = np.bincount(columns, weights=to_groups[columns, samples],
+                             minlength=num_labellings * num_groups)
+
+    within = within.reshape(num_labellings, num_groups) / group_sizes / 2
+    s_W = within.sum(axis=1)
+    s_A = s_T - s_W
+    return (s_A / (num_groups - 1)) / (s_W / (sample_size - num_groups))
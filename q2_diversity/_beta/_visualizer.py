@@ -16,7 +16,10 @@ import subprocess
 
 import skbio
 import skbio.diversity
+import numpy as np
 import pandas as pd
+import scipy.stats
+from scipy.spatial.distance import squareform
 import seaborn as sns
 import matplotlib.pyplot as plt
 from statsmodels.sandbox.stats.multicomp import multipletests
@@ -25,6 +28,10 @@ import q2templates
 from natsort import natsorted
 from patsy import ModelDesc
 
+from ._permanova import _Permanova
+from .._parallel import _resolve_n_jobs, _parallel_map, _SharedArray
+from .._permutation import _monte_carlo_p_value
+
 
 TEMPLATES = pkg_resources.resource_filename('q2_diversity', '_beta')
 
@@ -79,47 +86,83 @@ _beta_group_significance_fns = {'permanova': skbio.stats.distance.permanova,
 
 
 def _get_distance_boxplot_data(distance_matrix, group_id, groupings):
-    x_ticklabels = []
-    all_group_distances = []
-
-    # extract the within group distances
-    within_group_distances = []
-    pairs_summary = []
-    group = groupings[group_id]
-    for i, sid1 in enumerate(group):
-        for sid2 in group[:i]:
-            dist = distance_matrix[sid1, sid2]
-            within_group_distances.append(dist)
-            pairs_summary.append((sid1, sid2, group_id, group_id, dist))
-    x_ticklabels.append('%s (n=%d)' %
-                        (group_id, len(within_group_distances)))
-    all_group_distances.append(within_group_distances)
-
-    # extract between group distances for group to each other group
-    for other_group_id, other_group in groupings.items():
-        between_group_distances = []
+    """The distances within `group_id` and from it to each other group.
+
+    Distances are gathered with integer index arrays into
+    ``distance_matrix.data`` rather than looked up pair by pair. Returns one
+    array of distances per boxplot (within group first), their x tick labels,
+    and a DataFrame with one row per pair of samples.
+    """
+    data = distance_matrix.data
+    group_ids = np.asarray(groupings[group_id], dtype=object)
+    group = _id_positions(distance_matrix, group_ids)
+
+    # the within group distances, for each sample against the samples
+    # preceding it in the group
+    rows, cols = np.tril_indices(len(group), k=-1)
+    all_group_distances = [data[group[rows], group[cols]]]
+    x_ticklabels = ['%s (n=%d)' % (group_id, len(rows))]
+    sids1, sids2 = [group_ids[rows]], [group_ids[cols]]
+    other_group_ids = [group_id]
+
+    # the between group distances, from each sample in the group to each
+    # sample in every other group
+    for other_group_id, other_ids in groupings.items():
         if group_id == other_group_id:
             continue
-        for sid1 in group:
-            for sid2 in other_group:
-                dist = distance_matrix[sid1, sid2]
-                between_group_distances.append(dist)
-                pairs_summary.append(
-                    (sid1, sid2, group_id, other_group_id, dist))
-        x_ticklabels.append('%s (n=%d)' %
-                            (other_group_id, len(between_group_distances)))
-        all_group_distances.append(between_group_distances)
+        other_ids = np.asarray(other_ids, dtype=object)
+        other_group = _id_positions(distance_matrix, other_ids)
+        all_group_distances.append(
+            data[np.ix_(group, other_group)].ravel())
+        x_ticklabels.append('%s (n=%d)' % (other_group_id,
+                                           len(group) * len(other_group)))
+        sids1.append(np.repeat(group_ids, len(other_group)))
+        sids2.append(np.tile(other_ids, len(group)))
+        other_group_ids.append(other_group_id)
+
+    sizes = [len(distances) for distances in all_group_distances]
+    pairs_summary = pd.DataFrame({
+        'SubjectID1': np.concatenate(sids1),
+        'SubjectID2': np.concatenate(sids2),
+        'Group1': np.repeat(np.asarray([group_id], dtype=object),
+                            sum(sizes)),
+        'Group2': np.repeat(np.asarray(other_group_ids, dtype=object),
+                            sizes),
+        'Distance': np.concatenate(all_group_distances)})
     return all_group_distances, x_ticklabels, pairs_summary
 
 
-def _get_pairwise_group_significance_stats(
-        distance_matrix, group1_id, group2_id, groupings, metadata,
-        beta_group_significance_fn, permutations):
+def _id_positions(distance_matrix, ids):
+    return np.fromiter((distance_matrix.index(id_) for id_ in ids),
+                       dtype=np.intp, count=len(ids))
+
+
+def _get_pairwise_group_significance_stats(shared, task):
+    data, groupings, positions, metadata, method, permutations = shared
+    (group1_id, group2_id), seed = task
     group1_group2_samples = groupings[group1_id] + groupings[group2_id]
     metadata = metadata[group1_group2_samples]
-    distance_matrix = distance_matrix.filter(group1_group2_samples)
-    return beta_group_significance_fn(distance_matrix, metadata,
-                                      permutations=permutations)
+    group1_group2_positions = np.concatenate([positions[group1_id],
+                                              positions[group2_id]])
+    distance_matrix = skbio.DistanceMatrix(
+        data.array[np.ix_(group1_group2_positions, group1_group2_positions)],
+        group1_group2_samples)
+    # scikit-bio permutes with the global random state, which is seeded for
+    # the pair (and then restored)
+    state = np.random.get_state()
+    np.random.seed(seed.generate_state(1))
+    try:
+        return _beta_group_significance_fns[method](
+            distance_matrix, metadata, permutations=permutations)
+    finally:
+        np.random.set_state(state)
+
+
+def _get_pairwise_permanova_stats(shared, task):
+    permanova, permutations, exceedances = shared
+    pair, seed = task
+    return permanova.test(pair, permutations, np.random.default_rng(seed),
+                          exceedances=exceedances)
 
 
 def beta_group_significance(output_dir: str,
@@ -127,7 +170,9 @@ def beta_group_significance(output_dir: str,
                             metadata: qiime2.CategoricalMetadataColumn,
                             method: str = 'permanova',
                             pairwise: bool = False,
-                            permutations: int = 999) -> None:
+                            permutations: int = 999,
+                            n_jobs: int = 1,
+                            sequential_exceedances: int = None) -> None:
     try:
         beta_group_significance_fn = _beta_group_significance_fns[method]
     except KeyError:
@@ -135,6 +180,11 @@ def beta_group_significance(output_dir: str,
                          'options are %s.' %
                          (method,
                           ', '.join(_beta_group_significance_fns)))
+    if sequential_exceedances is not None and method != 'permanova':
+        raise ValueError('Sequential permutation tests (with '
+                         '`sequential_exceedances`) are only available for '
+                         'the permanova method, not %s.' % method)
+    n_jobs = _resolve_n_jobs(n_jobs)
 
     # Filter metadata to only include IDs present in the distance matrix.
     # Also ensures every distance matrix ID is present in the metadata.
@@ -150,9 +200,15 @@ def beta_group_significance(output_dir: str,
 
     metadata = metadata.to_series()
 
-    # Run the significance test
-    result = beta_group_significance_fn(distance_matrix, metadata,
-                                        permutations=permutations)
+    # Run the significance test. PERMANOVA squares the distances once, for
+    # this test and for all of the pairwise tests.
+    if method == 'permanova':
+        permanova = _Permanova(distance_matrix, metadata)
+        result = permanova.test(permutations=permutations,
+                                exceedances=sequential_exceedances)
+    else:
+        result = beta_group_significance_fn(distance_matrix, metadata,
+                                            permutations=permutations)
 
     # Generate distance boxplots
     sns.set_style('white')
@@ -167,17 +223,11 @@ def beta_group_significance(output_dir: str,
         [(id, list(series.index))
          for id, series in natsorted(metadata.groupby(metadata))])
 
-    pairs_summary = pd.DataFrame(columns=['SubjectID1', 'SubjectID2', 'Group1',
-                                          'Group2', 'Distance'])
+    pairs_summary = []
     for group_id in groupings:
         group_distances, x_ticklabels, group_pairs_summary = \
             _get_distance_boxplot_data(distance_matrix, group_id, groupings)
-
-        group_pairs_summary = pd.DataFrame(
-            group_pairs_summary, columns=['SubjectID1', 'SubjectID2',
-                                          'Group1', 'Group2', 'Distance'])
-
-        pairs_summary = pd.concat([pairs_summary, group_pairs_summary])
+        pairs_summary.append(group_pairs_summary)
 
         ax = sns.boxplot(data=group_distances, flierprops={
             'marker': 'o', 'markeredgecolor': 'black', 'markeredgewidth': 0.5,
@@ -198,26 +248,39 @@ def beta_group_significance(output_dir: str,
                                  urllib.parse.quote(str(group_id))))
         fig.clear()
 
+    pairs_summary = pd.concat(pairs_summary)
     pairs_summary.to_csv(os.path.join(output_dir, 'raw_data.tsv'), sep='\t')
 
     result_html = q2templates.df_to_html(result.to_frame())
 
     if pairwise:
+        # the pairwise tests run in parallel, with the distance matrix (or
+        # for PERMANOVA, the squared distances) handed to the workers through
+        # a memory-mapped file rather than filtered and pickled for every
+        # pair of groups
+        pairs = list(itertools.combinations(groupings, 2))
+        if method == 'permanova':
+            pairwise_fn = _get_pairwise_permanova_stats
+            shared = (permanova, permutations, sequential_exceedances)
+        else:
+            pairwise_fn = _get_pairwise_group_significance_stats
+            positions = {group_id: _id_positions(distance_matrix, group)
+                         for group_id, group in groupings.items()}
+            shared = (_SharedArray(distance_matrix.data), groupings,
+                      positions, metadata, method, permutations)
+        # Every pair gets its own seed, so results don't depend on how the
+        # pairs are spread across workers.
+        seeds = np.random.SeedSequence(
+            np.random.randint(np.iinfo(np.int32).max)).spawn(len(pairs))
         pairwise_results = []
-        for group1_id, group2_id in itertools.combinations(groupings, 2):
-            pairwise_result = \
-                _get_pairwise_group_significance_stats(
-                    distance_matrix=distance_matrix,
-                    group1_id=group1_id,
-                    group2_id=group2_id,
-                    groupings=groupings,
-                    metadata=metadata,
-                    beta_group_significance_fn=beta_group_significance_fn,
-                    permutations=permutations)
+        for (group1_id, group2_id), pairwise_result in zip(
+                pairs, _parallel_map(pairwise_fn, shared,
+                                     list(zip(pairs, seeds)), n_jobs)):
             pairwise_results.append([group1_id,
                                      group2_id,
                                      pairwise_result['sample size'],
-                                     permutations,
+                                     pairwise_result[
+                                         'number of permutations'],
                                      pairwise_result['test statistic'],
                                      pairwise_result['p-value']])
         columns = ['Group 1', 'Group 2', 'Sample size', 'Permutations',
@@ -265,11 +328,54 @@ def beta_group_significance(output_dir: str,
     })
 
 
+def _sequential_mantel(dm1, dm2, method, permutations, exceedances,
+                       rng=None):
+    """A two-sided Mantel test, as in ``skbio.stats.distance.mantel``, that
+    stops early once `exceedances` permutations have given a correlation at
+    least as large in magnitude as the observed one.
+
+    Returns the correlation, its p-value and the number of permutations run.
+    """
+    if rng is None:
+        rng = np.random.default_rng(np.random.randint(np.iinfo(np.int32).max))
+    dm2 = dm2.filter(dm1.ids)
+    x = dm1.condensed_form()
+    y = dm2.condensed_form()
+    if method == 'spearman':
+        x = scipy.stats.rankdata(x)
+        y = scipy.stats.rankdata(y)
+    # permuting the samples only reorders the distances (or their ranks), so
+    # their mean and norm are the same for every permutation
+    x = x - x.mean()
+    x /= np.linalg.norm(x)
+    y = y - y.mean()
+    y /= np.linalg.norm(y)
+    r = x @ y
+
+    x = squareform(x, checks=False)
+    rows, cols = np.triu_indices(dm1.shape[0], k=1)
+
+    def exceeded():
+        for _ in range(permutations):
+            order = rng.permutation(dm1.shape[0])
+            permuted = abs(x[order[rows], order[cols]] @ y)
+            # permutations that tie with the observed correlation are
+            # counted, even if the summation order changed its last bits
+            yield [permuted >= abs(r) or
+                   np.isclose(permuted, abs(r), rtol=1e-10, atol=0)]
+
+    p, permutations = _monte_carlo_p_value(exceeded(), exceedances)
+    if np.isnan(r):
+        p = np.nan
+    return r, p, permutations
+
+
 def mantel(output_dir: str, dm1: skbio.DistanceMatrix,
            dm2: skbio.DistanceMatrix, method: str = 'spearman',
            permutations: int = 999, intersect_ids: bool = False,
            label1: str = 'Distance Matrix 1',
-           label2: str = 'Distance Matrix 2') -> None:
+           label2: str = 'Distance Matrix 2',
+           sequential_exceedances: int = None) -> None:
     test_statistics = {'spearman': 'rho', 'pearson': 'r'}
     alt_hypothesis = 'two-sided'
 
@@ -305,10 +411,16 @@ def mantel(output_dir: str, dm1: skbio.DistanceMatrix,
         dm1 = dm1.filter(matched_ids, strict=True)
         dm2 = dm2.filter(matched_ids, strict=True)
 
-    # Run in `strict` mode because all IDs should be matched at this point.
-    r, p, sample_size = skbio.stats.distance.mantel(
-            dm1, dm2, method=method, permutations=permutations,
-            alternative=alt_hypothesis, strict=True)
+    if sequential_exceedances is None:
+        # Run in `strict` mode because all IDs should be matched at this
+        # point.
+        r, p, sample_size = skbio.stats.distance.mantel(
+                dm1, dm2, method=method, permutations=permutations,
+                alternative=alt_hypothesis, strict=True)
+    else:
+        r, p, permutations = _sequential_mantel(
+            dm1, dm2, method, permutations, sequential_exceedances)
+        sample_size = dm1.shape[0]
 
     result = pd.Series([method.title(), sample_size, permutations,
                        alt_hypothesis, r, p],
@@ -0,0 +1,91 @@
+# ----------------------------------------------------------------------------
+# Copyright (c) 2016-2021, QIIME 2 development team.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# ----------------------------------------------------------------------------
+
+import collections
+import concurrent.futures
+import tempfile
+
+import numpy as np
+import psutil
+
+
+def _resolve_n_jobs(n_jobs):
+    available = psutil.cpu_count(logical=False) or psutil.cpu_count()
+    if n_jobs == 'auto':
+        return available
+    if n_jobs > available:
+        raise ValueError('The requested number of jobs (%d) exceeds the '
+                         'number of available physical cores (%d).'
+                         % (n_jobs, available))
+    return n_jobs
+
+
+_worker_shared = None
+
+
+def _init_worker(shared):
+    global _worker_shared
+    _worker_shared = shared
+
+
+def _call_with_shared(function, task):
+    return function(_worker_shared, task)
+
+
+def _parallel_map(function, shared, tasks, n_jobs):
+    """Lazily yield ``function(shared, task)`` for each task, in order.
+
+    `shared` is handed to each worker process once, rather than with every
+    task. With ``n_jobs == 1`` everything runs in the calling process. Only a
+    bounded number of tasks are in flight at a time, so results that are
+    consumed as they arrive don't pile up in memory.
+    """
+    if n_jobs == 1:
+        for task in tasks:
+            yield function(shared, task)
+        return
+
+    with concurrent.futures.ProcessPoolExecutor(
+            n_jobs, initializer=_init_worker,
+            initargs=(shared,)) as executor:
+        pending = collections.deque()
+        for task in tasks:
+            pending.append(
+                executor.submit(_call_with_shared, function, task))
+            if len(pending) >= 2 * n_jobs:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
+class _SharedArray:
+    """An array that is handed to worker processes through a temporary
+    memory-mapped file instead of being pickled.
+
+    The file is only written the first time the array is pickled, so an
+    array that never leaves the calling process is never copied, and each
+    worker maps the same file read-only.
+    """
+
+    def __init__(self, array):
+        self.array = array
+        self._file = None
+        self._path = None
+
+    def __getstate__(self):
+        if self._path is None:
+            self._file = tempfile.NamedTemporaryFile(suffix='.npy')
+            np.save(self._file, np.asarray(self.array))
+            self._file.flush()
+            self._path = self._file.name
+        return {'path': self._path}
+
+    def __setstate__(self, state):
+        self._file = None
+        self._path = state['path']
+        self.array = np.load(self._path, mmap_mode='r')
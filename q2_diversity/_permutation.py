@@ -0,0 +1,36 @@
+# ----------------------------------------------------------------------------
+# Copyright (c) 2016-2021, QIIME 2 development team.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# ----------------------------------------------------------------------------
+
+import numpy as np
+
+
+def _monte_carlo_p_value(exceeded, exceedances=None):
+    """The p-value of a permutation test, and the number of permutations run.
+
+    `exceeded` lazily yields boolean arrays, in the order the permutations
+    were drawn, of whether each permutation's test statistic was at least as
+    extreme as the observed one. All of them are consumed unless
+    `exceedances` is given, in which case the test stops at the permutation
+    giving that many exceedances and the p-value is Besag and Clifford's
+    sequential Monte Carlo p-value, ``exceedances / permutations run``.
+    Otherwise the p-value is ``(exceedances + 1) / (permutations + 1)``, or
+    NaN if there were no permutations.
+    """
+    count = run = 0
+    for batch in exceeded:
+        batch = np.asarray(batch, dtype=bool)
+        if exceedances is not None and \
+                count + batch.sum() >= exceedances:
+            run += np.flatnonzero(batch)[exceedances - count - 1] + 1
+            return exceedances / run, int(run)
+        count += batch.sum()
+        run += len(batch)
+
+    if run == 0:
+        return np.nan, 0
+    return (count + 1) / (run + 1), int(run)
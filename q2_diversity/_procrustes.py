@@ -13,12 +13,15 @@ from skbio import OrdinationResults
 from scipy.spatial import procrustes
 from numpy.random import default_rng
 
+from ._permutation import _monte_carlo_p_value
+
 
 def procrustes_analysis(reference: OrdinationResults, other: OrdinationResults,
                         dimensions: int = 5,
-                        permutations: int = 999) -> (OrdinationResults,
-                                                     OrdinationResults,
-                                                     pd.DataFrame):
+                        permutations: int = 999,
+                        sequential_exceedances: int = None
+                        ) -> (OrdinationResults, OrdinationResults,
+                              pd.DataFrame):
 
     if reference.samples.shape != other.samples.shape:
         raise ValueError('The matrices cannot be fitted unless they have the '
@@ -48,7 +51,7 @@ def procrustes_analysis(reference: OrdinationResults, other: OrdinationResults,
 
     info = _procrustes_monte_carlo(reference.samples.values[:, :dimensions],
                                    other.samples.values[:, :dimensions],
-                                   m2, permutations)
+                                   m2, permutations, sequential_exceedances)
 
     out1 = OrdinationResults(
             short_method_name=reference.short_method_name,
@@ -74,39 +77,39 @@ def procrustes_analysis(reference: OrdinationResults, other: OrdinationResults,
 
 
 def _procrustes_monte_carlo(reference: np.ndarray, other: np.ndarray,
-                            true_m2, permutations) -> (pd.DataFrame):
+                            true_m2, permutations,
+                            exceedances=None) -> (pd.DataFrame):
     '''
     Outputs a dataframe containing:
     0: True M^2 value
     1: p-value for true M^2 value
     2: number of Monte Carlo permutations done in simulation
+
+    If `exceedances` is given, the simulation stops once that many
+    permutations gave an M^2 value below the true one.
     '''
 
     rng = default_rng()
 
-    trials_below_m2 = 0
-
     if permutations == 'disable':
         permutations = 0
 
-    for i in range(permutations):
+    def trials_below_m2():
+        for i in range(permutations):
 
-        # shuffle rows in np array
-        rng.shuffle(other)
+            # shuffle rows in np array
+            rng.shuffle(other)
 
-        # run procrustes analysis
-        _, _, m2 = procrustes(reference, other)
+            # run procrustes analysis
+            _, _, m2 = procrustes(reference, other)
 
-        # check m2 value
-        if m2 < true_m2:
-            trials_below_m2 += 1
+            # check m2 value
+            yield [m2 < true_m2]
 
-    if permutations == 0:
-        p_val = np.nan
-    else:
-        # mimic the behaviour in scikit-bio's permutation-based tests and avoid
-        # returning p-values equal to zero
-        p_val = (trials_below_m2 + 1) / (permutations + 1)
+    # mimic the behaviour in scikit-bio's permutation-based tests and avoid
+    # returning p-values equal to zero
+    p_val, permutations = _monte_carlo_p_value(trials_below_m2(),
+                                               exceedances)
 
     df = pd.DataFrame({'true M^2 value': [true_m2],
                        'p-value for true M^2 value': [p_val],
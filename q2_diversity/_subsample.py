@@ -0,0 +1,98 @@
+# ----------------------------------------------------------------------------
+# Copyright (c) 2016-2021, QIIME 2 development team.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# ----------------------------------------------------------------------------
+
+import biom
+import numpy as np
+import scipy.sparse
+
+
+class _DepthSortedCounts:
+    """A feature table's counts as a samples x features CSR matrix, with the
+    samples sorted by decreasing total frequency.
+
+    The samples that can be rarefied to any depth are then a leading slice of
+    the rows, so shallower samples are never touched. Building this once and
+    rarefying from it repeatedly also avoids converting the table each time.
+    """
+
+    def __init__(self, table):
+        counts = table.matrix_data.T.tocsr()
+        totals = np.asarray(counts.sum(axis=1)).ravel()
+        self.order = np.argsort(-totals, kind='stable')
+        self.counts = counts[self.order]
+        self.totals = totals[self.order]
+        self.sample_ids = table.ids(axis='sample')
+        self.feature_ids = table.ids(axis='observation')
+
+    def eligible(self, depth):
+        """The number of samples with a total frequency of at least
+        `depth`."""
+        return np.searchsorted(-self.totals, -depth, side='right')
+
+
+def _nested_rarefy(table, depths, rng=None):
+    """Rarefy `table` to each of `depths` from a single draw per sample.
+
+    Every sample is subsampled once (without replacement) to the deepest of
+    `depths` it can support, and each shallower depth is taken as a prefix of
+    that same draw, so the rarefied tables are nested: a read present at one
+    depth is present at every greater depth. Samples with a total frequency
+    below a depth are dropped from that depth's table, as are features that
+    end up with no counts.
+
+    `table` is a biom.Table or, when rarefying the same table repeatedly, a
+    `_DepthSortedCounts` built from it. Yields ``(depth, biom.Table)`` pairs
+    in ascending order of depth.
+    """
+    if rng is None:
+        rng = np.random.default_rng()
+    if not isinstance(table, _DepthSortedCounts):
+        table = _DepthSortedCounts(table)
+    depths = np.unique(np.asarray(depths, dtype=int))
+    counts = table.counts
+
+    # per-depth (row, column, value) triplets of the rarefied tables
+    drawn = [([], [], []) for _ in depths]
+    for sample in range(table.eligible(depths[0]) if len(depths) else 0):
+        n_eligible = np.searchsorted(depths, table.totals[sample],
+                                     side='right')
+        start, end = counts.indptr[sample], counts.indptr[sample + 1]
+        features = counts.indices[start:end]
+        remaining = counts.data[start:end].astype(np.int64)
+
+        # The reads added between consecutive depths are a uniform draw
+        # (without replacement) from the reads not yet drawn, which is the
+        # same as taking successive prefixes of a random order of the reads,
+        # without having to materialize that order.
+        running = np.zeros(len(features), dtype=np.int64)
+        previous = 0
+        for i, depth in enumerate(depths[:n_eligible]):
+            added = rng.multivariate_hypergeometric(
+                remaining, depth - previous, method='marginals')
+            running += added
+            remaining -= added
+            previous = depth
+            observed = running.nonzero()[0]
+            rows, cols, data = drawn[i]
+            # in the input table's sample order
+            rows.append(np.full(len(observed), table.order[sample]))
+            cols.append(features[observed])
+            data.append(running[observed])
+
+    empty = [np.empty(0, dtype=int)]
+    for depth, (rows, cols, data) in zip(depths, drawn):
+        rows = np.concatenate(rows or empty)
+        kept = np.unique(rows)
+        rarefied = scipy.sparse.csr_matrix(
+            (np.concatenate(data or empty),
+             (np.concatenate(cols or empty), np.searchsorted(kept, rows))),
+            shape=(len(table.feature_ids), len(kept)), dtype=float)
+        observed = np.asarray(rarefied.sum(axis=1)).ravel() > 0
+        yield depth, biom.Table(rarefied[observed],
+                                table.feature_ids[observed],
+                                table.sample_ids[kept])
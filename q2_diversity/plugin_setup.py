@@ -35,6 +35,16 @@ threads_description = (
     'host.'
 )
 
+sequential_exceedances_description = (
+    'Stop permuting early, once this many permutations have given a test '
+    'statistic at least as extreme as the observed one, and report Besag and '
+    'Clifford\'s sequential Monte Carlo p-value (this number divided by the '
+    'number of permutations run). `permutations` is then the most '
+    'permutations that will be run, and the number actually run is '
+    'reported. This is much quicker when the p-value is far from '
+    'significant. By default, all permutations are run.'
+)
+
 n_jobs_or_threads_description = (
     'The number of concurrent jobs or CPU threads to use in performing this '
     'calculation. Individual methods will create jobs/threads as implemented '
@@ -243,7 +253,8 @@ plugin.methods.register_function(
     inputs={'reference': PCoAResults, 'other': PCoAResults},
     parameters={
         'dimensions': Int % Range(1, None),
-        'permutations': Int % Range(1, None) | Str % Choices('disable')
+        'permutations': Int % Range(1, None) | Str % Choices('disable'),
+        'sequential_exceedances': Int % Range(1, None)
     },
     outputs=[
         ('transformed_reference', PCoAResults),
@@ -263,7 +274,7 @@ plugin.methods.register_function(
                         ' permutation testing and p-values will not be '
                         'calculated (this results in *much* quicker execution '
                         'time if p-values are not desired).',
-
+        'sequential_exceedances': sequential_exceedances_description,
     },
     output_descriptions={
         'transformed_reference': 'A normalized version of the "reference" '
@@ -274,7 +285,8 @@ plugin.methods.register_function(
                              'differences between the two input datasets & '
                              'its p value.'},
     name='Procrustes Analysis',
-    description='Fit two ordination matrices with Procrustes analysis'
+    description='Fit two ordination matrices with Procrustes analysis',
+    citations=[citations['besag1991sequential']]
 )
 
 plugin.pipelines.register_function(
@@ -558,7 +570,9 @@ plugin.visualizers.register_function(
     parameters={'method': Str % Choices(beta_group_significance_methods),
                 'permutations': Int,
                 'metadata': MetadataColumn[Categorical],
-                'pairwise': Bool},
+                'pairwise': Bool,
+                'n_jobs': Int % Range(1, None) | Str % Choices(['auto']),
+                'sequential_exceedances': Int % Range(1, None)},
     input_descriptions={
         'distance_matrix': 'Matrix of distances between pairs of samples.'
     },
@@ -570,13 +584,18 @@ plugin.visualizers.register_function(
         'pairwise': ('Perform pairwise tests between all pairs of groups '
                      'in addition to the test across all groups. '
                      'This can be very slow if there are a lot of groups '
-                     'in the metadata column.')
+                     'in the metadata column.'),
+        'n_jobs': n_jobs_description + ' The pairwise tests are run '
+                  'concurrently.',
+        'sequential_exceedances': '[permanova only] - %s'
+                                  % sequential_exceedances_description
     },
     name='Beta diversity group significance',
     description=('Determine whether groups of samples are significantly '
                  'different from one another using a permutation-based '
                  'statistical test.'),
-    citations=[citations['anderson2001new']]
+    citations=[citations['anderson2001new'],
+               citations['besag1991sequential']]
 )
 
 plugin.visualizers.register_function(
@@ -587,7 +606,8 @@ plugin.visualizers.register_function(
                 'method': Str % Choices(['spearman', 'pearson']),
                 'intersect_ids': Bool,
                 'label1': Str,
-                'label2': Str},
+                'label2': Str,
+                'sequential_exceedances': Int % Range(1, None)},
     name='Apply the Mantel test to two distance matrices',
     description='Apply a two-sided Mantel test to identify correlation '
                 'between two distance matrices.\n\nNote: the directionality '
@@ -616,12 +636,14 @@ plugin.visualizers.register_function(
                          'the Mantel test. Default behavior is to error on '
                          'any mismatched IDs.',
         'label1': 'Label for `dm1` in the output visualization.',
-        'label2': 'Label for `dm2` in the output visualization.'
+        'label2': 'Label for `dm2` in the output visualization.',
+        'sequential_exceedances': sequential_exceedances_description
     },
     citations=[
         citations['mantel1967detection'],
         citations['pearson1895note'],
-        citations['spearman1904proof']]
+        citations['spearman1904proof'],
+        citations['besag1991sequential']]
 )
 
 alpha_correlation_methods = \
@@ -665,7 +687,15 @@ plugin.visualizers.register_function(
                 'min_depth': Int % Range(1, None),
                 'max_depth': Int % Range(1, None),
                 'steps': Int % Range(2, None),
-                'iterations': Int % Range(1, None)},
+                'iterations': Int % Range(1, None),
+                'nested': Bool,
+                'n_jobs': Int % Range(1, None) | Str % Choices(['auto']),
+                'compact': Bool,
+                'depth_tolerance': Float % Range(0, None,
+                                                 inclusive_start=False),
+                'iteration_tolerance': Float % Range(0, None,
+                                                     inclusive_start=False),
+                'min_iterations': Int % Range(2, None)},
     input_descriptions={
         'table': 'Feature table to compute rarefaction curves from.',
         'phylogeny': 'Optional phylogeny for phylogenetic metrics.',
@@ -682,6 +712,45 @@ plugin.visualizers.register_function(
                   'between min_depth and max_depth.'),
         'iterations': ('The number of rarefied feature tables to '
                        'compute at each step.'),
+        'nested': ('Draw each iteration\'s rarefied feature tables from a '
+                   'single random subsample per sample, taking every '
+                   'depth as a prefix of that subsample. Each iteration '
+                   'then subsamples the table once instead of once per '
+                   'depth, and the rarefied tables at increasing depths are '
+                   'nested subsamples of one another, which reduces the '
+                   'noise between depths. Curves of richness-type metrics '
+                   '(e.g. observed_features) become monotone within an '
+                   'iteration; other metrics (e.g. shannon) may still '
+                   'decrease with depth.'),
+        'n_jobs': n_jobs_description,
+        'compact': ('Save each metric\'s results as a compressed NumPy '
+                    'archive (<metric>.npz) holding the samples x depths x '
+                    'iterations array, instead of as a CSV file. If no '
+                    'metadata is provided, at most 500 randomly selected '
+                    'samples are plotted.'),
+        'depth_tolerance': ('If provided, choose rarefaction depths '
+                            'adaptively instead of evenly spacing `steps` '
+                            'depths. Starting from a coarse grid, a depth is '
+                            'added between two neighboring depths while the '
+                            'median change of any metric between them '
+                            'exceeds this fraction of the metric\'s range, '
+                            'up to a total of `steps` depths. When combined '
+                            'with `nested`, depths added in different '
+                            'refinement rounds are drawn from separate '
+                            'subsamples.'),
+        'iteration_tolerance': ('If provided, treat `iterations` as an upper '
+                                'bound. After `min_iterations`, iterations '
+                                'are added at a depth only until the '
+                                'standard error of every metric\'s group '
+                                'medians, relative to their mean, is at '
+                                'most this value. Groups are the values of '
+                                'each metadata column, or individual samples '
+                                'if no metadata is provided. The number of '
+                                'iterations computed at each depth is '
+                                'included in the visualization.'),
+        'min_iterations': ('The number of iterations computed at every depth '
+                           'before checking for convergence. Only used with '
+                           '`iteration_tolerance`.'),
     },
     name='Alpha rarefaction curves',
     description=('Generate interactive alpha rarefaction curves by computing '
@@ -698,23 +767,27 @@ _beta_rarefaction_color_schemes = [
     'PuOr', 'PuOr_r', 'RdBu', 'RdBu_r', 'RdGy', 'RdGy_r',
     'RdYlBu', 'RdYlBu_r', 'RdYlGn', 'RdYlGn_r']
 
+_beta_metric = Str % Choices(beta.METRICS['NONPHYLO']['IMPL'] |
+                             beta.METRICS['NONPHYLO']['UNIMPL'] |
+                             beta.METRICS['PHYLO']['IMPL'] |
+                             beta.METRICS['PHYLO']['UNIMPL'])
 plugin.visualizers.register_function(
     function=q2_diversity._beta.beta_rarefaction,
     inputs={
         'table': FeatureTable[Frequency],
         'phylogeny': Phylogeny[Rooted]},
     parameters={
-        'metric': Str % Choices(beta.METRICS['NONPHYLO']['IMPL'] |
-                                beta.METRICS['NONPHYLO']['UNIMPL'] |
-                                beta.METRICS['PHYLO']['IMPL'] |
-                                beta.METRICS['PHYLO']['UNIMPL']),
+        'metric': _beta_metric,
         'clustering_method': Str % Choices({'nj', 'upgma'}),
         'metadata': Metadata,
         'sampling_depth': Int % Range(1, None),
         # Need at least two iterations to do a comparison.
         'iterations': Int % Range(2, None),
         'correlation_method': Str % Choices({'spearman', 'pearson'}),
-        'color_scheme': Str % Choices(_beta_rarefaction_color_schemes)
+        'color_scheme': Str % Choices(_beta_rarefaction_color_schemes),
+        'n_jobs': Int % Range(1, None) | Str % Choices(['auto']),
+        'pcoa_dimensions': Int % Range(3, None),
+        'metrics': Set[_beta_metric]
     },
     input_descriptions={
         'table': 'Feature table upon which to perform beta diversity '
@@ -745,11 +818,28 @@ plugin.visualizers.register_function(
                               'distance matrices.',
         'color_scheme': 'The matplotlib color scheme to generate the heatmap '
                         'with.',
+        'n_jobs': n_jobs_description + ' Rarefaction iterations are run '
+                  'concurrently, and any remaining jobs are passed to the '
+                  'beta diversity metric. The clustering and PCoA of each '
+                  'iteration are also run concurrently.',
+        'pcoa_dimensions': 'Number of dimensions to compute for the PCoA of '
+                           'each iteration in the Emperor jackknifed PCoA '
+                           'plot. By default, all eigenvectors are computed '
+                           'exactly with SciPy\'s eigh, which is slow for '
+                           'large numbers of samples. If specified, only this '
+                           'many are computed, with the faster but heuristic '
+                           'fsvd method (see the pcoa action). Emperor needs '
+                           'at least three dimensions, and plots at most the '
+                           'first five.',
+        'metrics': 'Additional beta diversity metrics to be computed along '
+                   'with `metric`. Each rarefied table is used for all of '
+                   'the metrics, and the visualization has a set of tabs for '
+                   'each metric.',
     },
     name='Beta diversity rarefaction',
     description='Repeatedly rarefy a feature table to compare beta diversity '
                 'results within a given rarefaction depth.\n\n'
-                'For a given beta diversity metric, this visualizer will '
+                'For each given beta diversity metric, this visualizer will '
                 'provide: an Emperor jackknifed PCoA plot, samples clustered '
                 'by UPGMA or neighbor joining with support calculation, and '
                 'a heatmap showing the correlation between rarefaction trials '
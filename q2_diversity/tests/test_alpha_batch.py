@@ -0,0 +1,88 @@
+# ----------------------------------------------------------------------------
+# Copyright (c) 2016-2021, QIIME 2 development team.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# ----------------------------------------------------------------------------
+
+import unittest
+
+import biom
+import numpy as np
+import numpy.testing as npt
+import pandas as pd
+
+from q2_diversity._alpha._batch import _alpha_batch, _batch_metrics
+
+
+class AlphaBatchTests(unittest.TestCase):
+    def setUp(self):
+        self.table = biom.Table(np.array([[1, 4, 0],
+                                          [1, 0, 3],
+                                          [2, 0, 0],
+                                          [0, 0, 0]]),
+                                ['O1', 'O2', 'O3', 'O4'], ['S1', 'S2', 'S3'])
+
+    def test_all_metrics(self):
+        obs = _alpha_batch(self.table, list(_batch_metrics))
+
+        self.assertEqual(list(obs.index), ['S1', 'S2', 'S3'])
+        self.assertEqual(list(obs.columns), list(_batch_metrics))
+
+    def test_observed_features(self):
+        obs = _alpha_batch(self.table, ['observed_features'])
+
+        exp = pd.DataFrame({'observed_features': [3, 1, 1]},
+                           index=['S1', 'S2', 'S3'])
+        pd.testing.assert_frame_equal(obs, exp, check_dtype=False)
+
+    def test_shannon(self):
+        obs = _alpha_batch(self.table, ['shannon'])['shannon']
+
+        npt.assert_almost_equal(obs, [1.5, 0., 0.])
+
+    def test_evenness_single_feature(self):
+        obs = _alpha_batch(self.table, ['pielou_e', 'heip_e'])
+
+        npt.assert_almost_equal(obs.loc['S1', 'pielou_e'],
+                                1.5 * np.log(2) / np.log(3))
+        npt.assert_almost_equal(obs.loc['S1', 'heip_e'],
+                                (np.exp(1.5 * np.log(2)) - 1) / 2)
+        self.assertTrue(obs.loc[['S2', 'S3']].isna().all().all())
+
+    def test_simpson_family(self):
+        obs = _alpha_batch(self.table,
+                           ['simpson', 'dominance', 'enspie', 'simpson_e'])
+
+        npt.assert_almost_equal(obs.loc['S1'], [0.625, 0.375, 8 / 3, 8 / 9])
+        npt.assert_almost_equal(obs.loc['S2'], [0., 1., 1., 1.])
+
+    def test_singleton_based(self):
+        obs = _alpha_batch(self.table, ['singles', 'doubles', 'chao1',
+                                        'goods_coverage'])
+
+        npt.assert_array_equal(obs['singles'], [2, 0, 0])
+        npt.assert_array_equal(obs['doubles'], [1, 0, 0])
+        # bias-corrected: 3 + 2 * 1 / (2 * (1 + 1))
+        npt.assert_almost_equal(obs['chao1'], [3.5, 1., 1.])
+        npt.assert_almost_equal(obs['goods_coverage'], [0.5, 1., 1.])
+
+    def test_count_based(self):
+        obs = _alpha_batch(self.table, ['berger_parker_d', 'margalef',
+                                        'menhinick', 'mcintosh_d',
+                                        'brillouin_d'])
+
+        npt.assert_almost_equal(obs.loc['S1'],
+                                [0.5, 2 / np.log(4), 1.5,
+                                 (4 - np.sqrt(6)) / 2,
+                                 (np.log(24) - np.log(2)) / 4])
+        npt.assert_almost_equal(obs.loc['S2', 'brillouin_d'], 0.)
+
+    def test_unsupported_metric(self):
+        with self.assertRaisesRegex(ValueError, 'faith_pd'):
+            _alpha_batch(self.table, ['shannon', 'faith_pd'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -13,6 +13,7 @@ import unittest
 
 import biom
 import numpy as np
+import numpy.testing as npt
 import pandas.testing as pdt
 import qiime2
 import skbio
@@ -23,7 +24,7 @@ from q2_types.tree import NewickFormat
 from q2_diversity import alpha_rarefaction
 from q2_diversity._alpha._visualizer import (
     _compute_rarefaction_data, _compute_summary, _reindex_with_metadata,
-    _alpha_rarefaction_jsonp)
+    _alpha_rarefaction_jsonp, _refine_depths, _iterations_converged)
 
 
 class AlphaRarefactionTests(unittest.TestCase):
@@ -114,6 +115,45 @@ class AlphaRarefactionTests(unittest.TestCase):
                 os.path.exists(os.path.join(output_dir,
                                'shannon_entropy-bar.jsonp')))
 
+    def test_alpha_rarefaction_compact(self):
+        t = biom.Table(np.array([[100, 111, 113], [111, 111, 112]]),
+                       ['O1', 'O2'],
+                       ['S1', 'S2', 'S3'])
+        with tempfile.TemporaryDirectory() as output_dir:
+            alpha_rarefaction(output_dir, t, max_depth=200, steps=4,
+                              iterations=3, compact=True)
+
+            self.assertFalse(os.path.exists(
+                os.path.join(output_dir, 'shannon.csv')))
+            self.assertFalse(os.path.exists(
+                os.path.join(output_dir, 'observed_features.csv')))
+            with np.load(os.path.join(output_dir, 'shannon.npz')) as obs:
+                self.assertEqual(obs['values'].shape, (3, 4, 3))
+                self.assertEqual(list(obs['sample_ids']), ['S1', 'S2', 'S3'])
+                self.assertEqual(list(obs['depths']), [1, 67, 133, 200])
+                self.assertEqual(list(obs['iterations']), [1, 2, 3])
+            with open(os.path.join(output_dir, 'index.html')) as index_fh:
+                index_contents = index_fh.read()
+            self.assertNotIn('randomly selected samples', index_contents)
+            self.assertIn('href="shannon.npz"', index_contents)
+            self.assertNotIn('Download CSV', index_contents)
+
+    def test_alpha_rarefaction_iteration_tolerance(self):
+        t = biom.Table(np.array([[100, 111, 113], [111, 111, 112]]),
+                       ['O1', 'O2'],
+                       ['S1', 'S2', 'S3'])
+        with tempfile.TemporaryDirectory() as output_dir:
+            alpha_rarefaction(output_dir, t, max_depth=200, steps=2,
+                              iterations=5, iteration_tolerance=10.,
+                              min_iterations=2)
+
+            obs = pd.read_csv(os.path.join(output_dir,
+                                           'iterations-used.csv'))
+            exp = pd.DataFrame({'depth': [1, 200], 'iterations': [2, 2]})
+            pdt.assert_frame_equal(obs, exp)
+            with open(os.path.join(output_dir, 'index.html')) as index_fh:
+                self.assertIn('iterations-used.csv', index_fh.read())
+
     def test_alpha_rarefaction_with_depth_column_in_metadata(self):
         t = biom.Table(np.array([[100, 111, 113], [111, 111, 112]]),
                        ['O1', 'O2'],
@@ -212,6 +252,11 @@ class AlphaRarefactionTests(unittest.TestCase):
                 alpha_rarefaction(output_dir, t, max_depth=200,
                                   metadata=md, metrics=set())
 
+            with self.assertRaisesRegex(ValueError, 'min_iterations'):
+                alpha_rarefaction(output_dir, t, max_depth=200,
+                                  iterations=3, iteration_tolerance=0.1,
+                                  min_iterations=4)
+
     def test_alpha_rarefaction_with_metric_set(self):
         t = biom.Table(np.array([[100, 111, 113], [111, 111, 112]]),
                        ['O1', 'O2'],
@@ -285,7 +330,7 @@ class ComputeRarefactionDataTests(unittest.TestCase):
         exp_ind = pd.MultiIndex.from_product(
             [[1, 200], [1]],
             names=['_alpha_rarefaction_depth_column_', 'iter'])
-        exp = pd.DataFrame(data=[[1, 2], [1, 2], [1, 2]],
+        exp = pd.DataFrame(data=[[1., 2.], [1., 2.], [1., 2.]],
                            columns=exp_ind,
                            index=['S1', 'S2', 'S3'])
         pdt.assert_frame_equal(obs['observed_features'], exp)
@@ -323,7 +368,7 @@ class ComputeRarefactionDataTests(unittest.TestCase):
         exp_ind = pd.MultiIndex.from_product(
             [[1, 200], [1]],
             names=['_alpha_rarefaction_depth_column_', 'iter'])
-        exp = pd.DataFrame(data=[[1, 2], [1, 2], [1, 2]],
+        exp = pd.DataFrame(data=[[1., 2.], [1., 2.], [1., 2.]],
                            columns=exp_ind,
                            index=['S1', 'S2', 'S3'])
         pdt.assert_frame_equal(obs['observed_features'], exp)
@@ -333,6 +378,157 @@ class ComputeRarefactionDataTests(unittest.TestCase):
                            index=['S1', 'S2', 'S3'])
         pdt.assert_frame_equal(obs['shannon'], exp)
 
+    def test_unbatched_metric(self):
+        t = biom.Table(np.array([[150, 100, 100], [50, 100, 100]]),
+                       ['O1', 'O2'],
+                       ['S1', 'S2', 'S3'])
+        obs = _compute_rarefaction_data(feature_table=t,
+                                        min_depth=1,
+                                        max_depth=200,
+                                        steps=2,
+                                        iterations=1,
+                                        phylogeny=None,
+                                        metrics=['observed_features',
+                                                 'gini_index'])
+
+        self.assertEqual(obs['gini_index'].shape, (3, 2))
+        self.assertFalse(obs['gini_index'][(200, 1)].isna().any())
+
+    def test_nested(self):
+        t = biom.Table(np.array([[150, 100, 100], [50, 100, 100]]),
+                       ['O1', 'O2'],
+                       ['S1', 'S2', 'S3'])
+        obs = _compute_rarefaction_data(feature_table=t,
+                                        min_depth=1,
+                                        max_depth=200,
+                                        steps=2,
+                                        iterations=2,
+                                        phylogeny=None,
+                                        metrics=['observed_features'],
+                                        nested=True)
+
+        exp_ind = pd.MultiIndex.from_product(
+            [[1, 200], [1, 2]],
+            names=['_alpha_rarefaction_depth_column_', 'iter'])
+        exp = pd.DataFrame(data=[[1., 1., 2., 2.], [1., 1., 2., 2.],
+                                 [1., 1., 2., 2.]],
+                           columns=exp_ind,
+                           index=['S1', 'S2', 'S3'])
+        pdt.assert_frame_equal(obs['observed_features'], exp)
+
+    def test_n_jobs_reproducible(self):
+        t = biom.Table(np.array([[150, 100, 100], [50, 100, 100]]),
+                       ['O1', 'O2'],
+                       ['S1', 'S2', 'S3'])
+        obs = {}
+        for n_jobs in (1, 2):
+            np.random.seed(0)
+            obs[n_jobs] = _compute_rarefaction_data(
+                feature_table=t, min_depth=1, max_depth=200, steps=4,
+                iterations=3, phylogeny=None, metrics=['shannon'],
+                n_jobs=n_jobs)
+
+        pdt.assert_frame_equal(obs[1]['shannon'], obs[2]['shannon'])
+
+    def test_adaptive_depths(self):
+        t = biom.Table(np.array([[150, 100, 100], [50, 100, 100],
+                                 [10, 1, 0]]),
+                       ['O1', 'O2', 'O3'],
+                       ['S1', 'S2', 'S3'])
+        obs = _compute_rarefaction_data(feature_table=t,
+                                        min_depth=1,
+                                        max_depth=200,
+                                        steps=6,
+                                        iterations=2,
+                                        phylogeny=None,
+                                        metrics=['observed_features'],
+                                        depth_tolerance=0.01)
+
+        depths = list(obs['observed_features'].columns.get_level_values(
+            0).unique())
+        self.assertEqual(depths[0], 1)
+        self.assertEqual(depths[-1], 200)
+        self.assertEqual(depths, sorted(depths))
+        self.assertLessEqual(len(depths), 6)
+        self.assertGreater(len(depths), 3)
+        self.assertEqual(obs['observed_features'].shape, (3, 2 * len(depths)))
+
+    def test_iteration_tolerance(self):
+        t = biom.Table(np.array([[150, 100, 100], [50, 100, 100]]),
+                       ['O1', 'O2'],
+                       ['S1', 'S2', 'S3'])
+        for tolerance, exp in ((10., 2), (1e-9, 4)):
+            np.random.seed(0)
+            obs = _compute_rarefaction_data(feature_table=t,
+                                            min_depth=10,
+                                            max_depth=200,
+                                            steps=2,
+                                            iterations=4,
+                                            phylogeny=None,
+                                            metrics=['shannon'],
+                                            iteration_tolerance=tolerance,
+                                            min_iterations=2)
+
+            computed = obs['shannon'].notna().all(axis=0)
+            self.assertEqual(list(computed[10]), [True] * exp +
+                             [False] * (4 - exp))
+            # the full table is the same in every iteration
+            self.assertEqual(list(computed[200]), [True, True, False, False])
+
+
+class IterationsConvergedTests(unittest.TestCase):
+    def setUp(self):
+        # 1 metric x 4 samples x 3 iterations
+        self.values = np.array([[[1., 1., 1.],
+                                 [2., 2., 2.],
+                                 [1., 2., 3.],
+                                 [3., 2., 1.]]])
+
+    def test_per_sample(self):
+        # sample 3's standard error is 1 / sqrt(3), relative to a mean of 2
+        self.assertTrue(_iterations_converged(self.values, None, 0.29))
+        self.assertFalse(_iterations_converged(self.values, None, 0.28))
+
+    def test_groups(self):
+        # the medians of samples {3, 4} are [2, 2, 2]
+        groupings = [np.array([0, 0, 1, 1])]
+        self.assertTrue(_iterations_converged(self.values, groupings, 0.))
+
+    def test_missing_samples_ignored(self):
+        self.values[:, 2:] = np.nan
+        groupings = [np.array([0, 0, 1, -1])]
+
+        self.assertTrue(_iterations_converged(self.values, groupings, 0.))
+        self.assertTrue(_iterations_converged(self.values, None, 0.))
+
+
+class RefineDepthsTests(unittest.TestCase):
+    def setUp(self):
+        columns = pd.MultiIndex.from_product([[1, 100, 200], [1, 2]],
+                                             names=['depth', 'iter'])
+        self.data = {'m': pd.DataFrame(data=[[1, 1, 10, 10, 10, 10],
+                                             [2, 2, 12, 12, 12, 12]],
+                                       columns=columns, index=['S1', 'S2'])}
+        self.depths = np.array([1, 100, 200])
+
+    def test_split_changing_interval(self):
+        obs = _refine_depths(self.data, self.depths, 0.1, 5)
+        npt.assert_array_equal(obs, [50])
+
+    def test_within_tolerance(self):
+        obs = _refine_depths(self.data, self.depths, 0.9, 5)
+        npt.assert_array_equal(obs, [])
+
+    def test_budget(self):
+        obs = _refine_depths(self.data, self.depths, 0.1, 0)
+        npt.assert_array_equal(obs, [])
+
+    def test_missing_samples_ignored(self):
+        self.data['m'].iloc[0, 2:] = np.nan
+
+        obs = _refine_depths(self.data, self.depths, 0.1, 5)
+        npt.assert_array_equal(obs, [50])
+
 
 class ComputeSummaryTests(unittest.TestCase):
     def test_one_iteration_no_metadata(self):
@@ -396,6 +592,22 @@ class ComputeSummaryTests(unittest.TestCase):
                                             '75%', '91%', '98%', 'max'])
         pdt.assert_frame_equal(exp, obs)
 
+    def test_shallow_sample_no_metadata(self):
+        columns = pd.MultiIndex.from_product([[1, 200], [1, 2]],
+                                             names=['depth', 'iter'])
+        data = pd.DataFrame(data=[[1, 2, 3, 4], [1, 2, np.nan, np.nan]],
+                            columns=columns, index=['S1', 'S2'])
+
+        obs = _compute_summary(data, 'sample-id')
+
+        d = [['S1', 1,   1, 1., 1.02, 1.09, 1.25, 1.5, 1.75, 1.91, 1.98, 2.],
+             ['S1', 200, 1, 3., 3.02, 3.09, 3.25, 3.5, 3.75, 3.91, 3.98, 4.],
+             ['S2', 1,   1, 1., 1.02, 1.09, 1.25, 1.5, 1.75, 1.91, 1.98, 2.]]
+        exp = pd.DataFrame(data=d, columns=['sample-id', 'depth', 'count',
+                                            'min', '2%', '9%', '25%', '50%',
+                                            '75%', '91%', '98%', 'max'])
+        pdt.assert_frame_equal(exp, obs)
+
     def test_two_iterations_with_metadata_were_values_are_unique(self):
         # This should be identical to test_without_metadata_df_two_iterations,
         # with just the `sample-id` replaced with `pet`.
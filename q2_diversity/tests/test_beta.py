@@ -18,13 +18,17 @@ import numpy as np
 import numpy.testing as npt
 from biom.table import Table
 import pandas as pd
+import pandas.testing as pdt
 import qiime2
 from qiime2.plugin.testing import TestPluginBase
 
 
 from qiime2 import Artifact
 from q2_diversity import (bioenv, beta_group_significance, mantel)
-from q2_diversity._beta._visualizer import _get_distance_boxplot_data
+from q2_diversity._beta._visualizer import (_get_distance_boxplot_data,
+                                            _sequential_mantel)
+from q2_diversity._beta._permanova import _Permanova
+import q2_diversity._beta._permanova
 
 
 class BetaDiversityTests(TestPluginBase):
@@ -600,6 +604,33 @@ class BetaGroupSignificanceTests(unittest.TestCase):
             self.assertFalse('Warning' in open(index_fp).read())
             self.assertTrue('Pairwise anosim' in open(index_fp).read())
 
+    def test_pairwise_n_jobs(self):
+        dm = skbio.DistanceMatrix([[0.00, 0.25, 0.25, 0.66, 0.70, 0.12],
+                                   [0.25, 0.00, 0.10, 0.66, 0.71, 0.31],
+                                   [0.25, 0.10, 0.00, 0.62, 0.64, 0.35],
+                                   [0.66, 0.66, 0.62, 0.00, 0.05, 0.60],
+                                   [0.70, 0.71, 0.64, 0.05, 0.00, 0.58],
+                                   [0.12, 0.31, 0.35, 0.60, 0.58, 0.00]],
+                                  ids=['s1', 's2', 's3', 's4', 's5', 's6'])
+        md = qiime2.CategoricalMetadataColumn(
+            pd.Series(['a', 'b', 'b', 'c', 'c', 'a'], name='abc',
+                      index=pd.Index(['s1', 's2', 's3', 's4', 's5', 's6'],
+                                     name='id')))
+
+        for method in ('permanova', 'anosim', 'permdisp'):
+            results = []
+            for n_jobs in (1, 2):
+                np.random.seed(0)
+                with tempfile.TemporaryDirectory() as output_dir:
+                    beta_group_significance(output_dir, dm, md,
+                                            method=method, permutations=99,
+                                            pairwise=True, n_jobs=n_jobs)
+                    results.append(pd.read_csv(os.path.join(
+                        output_dir, '%s-pairwise.csv' % method)))
+
+            self.assertEqual(len(results[0]), 3)
+            pdt.assert_frame_equal(results[0], results[1])
+
     def test_alt_permutations(self):
         dm = skbio.DistanceMatrix([[0.00, 0.25, 0.25],
                                    [0.25, 0.00, 0.00],
@@ -629,6 +660,28 @@ class BetaGroupSignificanceTests(unittest.TestCase):
             with tempfile.TemporaryDirectory() as output_dir:
                 beta_group_significance(output_dir, dm, md, method='bad!')
 
+    def test_sequential_exceedances(self):
+        dm = skbio.DistanceMatrix([[0.00, 0.25, 0.25],
+                                   [0.25, 0.00, 0.00],
+                                   [0.25, 0.00, 0.00]],
+                                  ids=['sample1', 'sample2', 'sample3'])
+        md = qiime2.CategoricalMetadataColumn(
+            pd.Series(['a', 'b', 'b'], name='a or b',
+                      index=pd.Index(['sample1', 'sample2', 'sample3'],
+                                     name='id')))
+
+        # every permutation is at least as extreme as the observed grouping
+        with tempfile.TemporaryDirectory() as output_dir:
+            beta_group_significance(output_dir, dm, md, permutations=999,
+                                    sequential_exceedances=7)
+            index_fp = os.path.join(output_dir, 'index.html')
+            self.assertTrue('<td>7</td>' in open(index_fp).read())
+
+        with self.assertRaisesRegex(ValueError, 'only available.*anosim'):
+            with tempfile.TemporaryDirectory() as output_dir:
+                beta_group_significance(output_dir, dm, md, method='anosim',
+                                        sequential_exceedances=7)
+
     def test_filtered_samples_numeric_metadata(self):
         dm = skbio.DistanceMatrix([[0.00, 0.25, 0.25, 0.66],
                                    [0.25, 0.00, 0.00, 0.66],
@@ -689,7 +742,7 @@ class BetaGroupSignificanceTests(unittest.TestCase):
         obs = _get_distance_boxplot_data(dm, 'g1', groupings)
         exp_data = [[0.12], [0.13, 0.14, 0.15, 0.22, 0.23, 0.24]]
         exp_labels = ['g1 (n=1)', 'g2 (n=6)']
-        self.assertEqual(obs[0], exp_data)
+        self.assertEqual([list(d) for d in obs[0]], exp_data)
         self.assertEqual(obs[1], exp_labels)
 
     def test_get_distance_boxplot_data_within_always_first(self):
@@ -705,16 +758,19 @@ class BetaGroupSignificanceTests(unittest.TestCase):
         obs = _get_distance_boxplot_data(dm, 'g1', groupings)
         exp_data = [[0.12], [0.13, 0.14, 0.15, 0.22, 0.23, 0.24]]
         exp_labels = ['g1 (n=1)', 'g2 (n=6)']
-        exp_summary = [('s2', 's1', 'g1', 'g1', 0.12),
-                       ('s1', 's3', 'g1', 'g2', 0.13),
-                       ('s1', 's4', 'g1', 'g2', 0.14000000000000001),
-                       ('s1', 's5', 'g1', 'g2', 0.14999999999999999),
-                       ('s2', 's3', 'g1', 'g2', 0.22),
-                       ('s2', 's4', 'g1', 'g2', 0.23000000000000001),
-                       ('s2', 's5', 'g1', 'g2', 0.23999999999999999)]
-        self.assertEqual(obs[0], exp_data)
+        exp_summary = pd.DataFrame(
+            [('s2', 's1', 'g1', 'g1', 0.12),
+             ('s1', 's3', 'g1', 'g2', 0.13),
+             ('s1', 's4', 'g1', 'g2', 0.14000000000000001),
+             ('s1', 's5', 'g1', 'g2', 0.14999999999999999),
+             ('s2', 's3', 'g1', 'g2', 0.22),
+             ('s2', 's4', 'g1', 'g2', 0.23000000000000001),
+             ('s2', 's5', 'g1', 'g2', 0.23999999999999999)],
+            columns=['SubjectID1', 'SubjectID2', 'Group1', 'Group2',
+                     'Distance'])
+        self.assertEqual([list(d) for d in obs[0]], exp_data)
         self.assertEqual(obs[1], exp_labels)
-        self.assertEqual(obs[2], exp_summary)
+        pdt.assert_frame_equal(obs[2], exp_summary, check_dtype=False)
 
     def test_get_distance_boxplot_data_three_groups(self):
         dm = skbio.DistanceMatrix([[0.00, 0.12, 0.13, 0.14, 0.15],
@@ -729,7 +785,7 @@ class BetaGroupSignificanceTests(unittest.TestCase):
         obs = _get_distance_boxplot_data(dm, 'g1', groupings)
         exp_data = [[0.12], [0.13, 0.15, 0.22, 0.24], [0.14, 0.23]]
         exp_labels = ['g1 (n=1)', 'g2 (n=4)', 'g3 (n=2)']
-        self.assertEqual(obs[0], exp_data)
+        self.assertEqual([list(d) for d in obs[0]], exp_data)
         self.assertEqual(obs[1], exp_labels)
 
     def test_get_distance_boxplot_data_between_order_retained(self):
@@ -745,10 +801,147 @@ class BetaGroupSignificanceTests(unittest.TestCase):
         obs = _get_distance_boxplot_data(dm, 'g1', groupings)
         exp_data = [[0.12], [0.14, 0.23], [0.13, 0.15, 0.22, 0.24]]
         exp_labels = ['g1 (n=1)', 'g3 (n=2)', 'g2 (n=4)']
-        self.assertEqual(obs[0], exp_data)
+        self.assertEqual([list(d) for d in obs[0]], exp_data)
         self.assertEqual(obs[1], exp_labels)
 
 
+class PermanovaTests(unittest.TestCase):
+    def setUp(self):
+        self.dm = skbio.DistanceMatrix(
+            [[0.00, 0.25, 0.25, 0.66, 0.70, 0.12, 0.40],
+             [0.25, 0.00, 0.10, 0.66, 0.71, 0.31, 0.45],
+             [0.25, 0.10, 0.00, 0.62, 0.64, 0.35, 0.38],
+             [0.66, 0.66, 0.62, 0.00, 0.05, 0.60, 0.21],
+             [0.70, 0.71, 0.64, 0.05, 0.00, 0.58, 0.27],
+             [0.12, 0.31, 0.35, 0.60, 0.58, 0.00, 0.49],
+             [0.40, 0.45, 0.38, 0.21, 0.27, 0.49, 0.00]],
+            ids=['s1', 's2', 's3', 's4', 's5', 's6', 's7'])
+        # not in the same order as the distance matrix
+        self.grouping = pd.Series(['c', 'a', 'c', 'c', 'b', 'b', 'a'],
+                                  index=['s7', 's6', 's5', 's4', 's3', 's2',
+                                         's1'], name='abc')
+
+    def test_all_groups(self):
+        obs = _Permanova(self.dm, self.grouping).test(permutations=99)
+        exp = skbio.stats.distance.permanova(self.dm, self.grouping,
+                                             permutations=99)
+
+        self.assertEqual(obs.name, exp.name)
+        self.assertEqual(list(obs.index), list(exp.index))
+        self.assertAlmostEqual(obs['test statistic'], exp['test statistic'])
+        self.assertEqual(obs['sample size'], 7)
+        self.assertEqual(obs['number of groups'], 3)
+        self.assertEqual(obs['number of permutations'], 99)
+        self.assertTrue(0 < obs['p-value'] <= 1)
+
+    def test_pair_of_groups(self):
+        permanova = _Permanova(self.dm, self.grouping)
+        samples = ['s4', 's5', 's7', 's1', 's6']
+
+        obs = permanova.test(['c', 'a'], permutations=0)
+        exp = skbio.stats.distance.permanova(
+            self.dm.filter(samples), self.grouping[samples], permutations=0)
+
+        self.assertAlmostEqual(obs['test statistic'], exp['test statistic'])
+        self.assertEqual(obs['sample size'], 5)
+        self.assertEqual(obs['number of groups'], 2)
+        self.assertTrue(np.isnan(obs['p-value']))
+
+    def test_batches(self):
+        permanova = _Permanova(self.dm, self.grouping)
+        rng = np.random.default_rng(7)
+        exp = permanova.test(permutations=50, rng=rng)
+
+        # a single permutation per batch
+        memory_budget = q2_diversity._beta._permanova._memory_budget
+        q2_diversity._beta._permanova._memory_budget = 1
+        try:
+            obs = permanova.test(permutations=50,
+                                 rng=np.random.default_rng(7))
+        finally:
+            q2_diversity._beta._permanova._memory_budget = memory_budget
+
+        self.assertAlmostEqual(obs['test statistic'], exp['test statistic'])
+        self.assertAlmostEqual(obs['p-value'], exp['p-value'])
+
+    def test_global_random_state(self):
+        permanova = _Permanova(self.dm, self.grouping)
+
+        np.random.seed(0)
+        exp = permanova.test(permutations=99)
+        np.random.seed(0)
+        obs = permanova.test(permutations=99)
+
+        self.assertEqual(obs['p-value'], exp['p-value'])
+
+    def test_sparse_indicators(self):
+        permanova = _Permanova(self.dm, self.grouping)
+        exp = permanova.test(permutations=50, rng=np.random.default_rng(7))
+
+        sparse_groups = q2_diversity._beta._permanova._sparse_groups
+        q2_diversity._beta._permanova._sparse_groups = 2
+        try:
+            obs = permanova.test(permutations=50,
+                                 rng=np.random.default_rng(7))
+        finally:
+            q2_diversity._beta._permanova._sparse_groups = sparse_groups
+
+        self.assertAlmostEqual(obs['test statistic'], exp['test statistic'])
+        self.assertAlmostEqual(obs['p-value'], exp['p-value'])
+
+    def test_sequential(self):
+        permanova = _Permanova(self.dm, self.grouping)
+        rng = np.random.default_rng(11)
+        exp = permanova.test(permutations=999, rng=rng)
+
+        # a single permutation per batch, so that none are run after the
+        # tenth exceedance
+        first_batch_size = q2_diversity._beta._permanova._first_batch_size
+        q2_diversity._beta._permanova._first_batch_size = 1
+        memory_budget = q2_diversity._beta._permanova._memory_budget
+        q2_diversity._beta._permanova._memory_budget = 1
+        try:
+            obs = permanova.test(permutations=999, exceedances=10,
+                                 rng=np.random.default_rng(11))
+        finally:
+            q2_diversity._beta._permanova._first_batch_size = \
+                first_batch_size
+            q2_diversity._beta._permanova._memory_budget = memory_budget
+
+        self.assertAlmostEqual(obs['test statistic'], exp['test statistic'])
+        self.assertLess(obs['number of permutations'], 999)
+        self.assertEqual(obs['p-value'], 10 / obs['number of permutations'])
+
+    def test_sequential_not_stopped(self):
+        obs = _Permanova(self.dm, self.grouping).test(permutations=9,
+                                                      exceedances=1000)
+
+        self.assertEqual(obs['number of permutations'], 9)
+        self.assertEqual(obs['p-value'] * 10 % 1, 0)
+
+    def test_ties_counted(self):
+        # every relabelling of these two groups gives the same statistic
+        dm = skbio.DistanceMatrix([[0.0, 1.0, 1.0, 1.0],
+                                   [1.0, 0.0, 1.0, 1.0],
+                                   [1.0, 1.0, 0.0, 1.0],
+                                   [1.0, 1.0, 1.0, 0.0]],
+                                  ids=['s1', 's2', 's3', 's4'])
+        grouping = pd.Series(['a', 'a', 'b', 'b'], index=dm.ids, name='ab')
+
+        obs = _Permanova(dm, grouping).test(permutations=19)
+
+        self.assertEqual(obs['p-value'], 1.0)
+
+    def test_unique_groups(self):
+        with self.assertRaisesRegex(ValueError, 'unique'):
+            _Permanova(self.dm.filter(['s1', 's2']),
+                       self.grouping[['s1', 's2']]).test()
+
+    def test_single_group(self):
+        with self.assertRaisesRegex(ValueError, 'the same'):
+            _Permanova(self.dm, self.grouping).test(['c'])
+
+
 class TestMantel(unittest.TestCase):
     def setUp(self):
         self.dm1 = skbio.DistanceMatrix([[0.00, 0.25, 0.25],
@@ -870,6 +1063,40 @@ class TestMantel(unittest.TestCase):
         self.assertBasicVizValidity(self.output_dir, 3, permutations=42,
                                     exp_test_stat=0.5, exp_p_value=1.0)
 
+    def test_sequential_exceedances(self):
+        # every permutation gives a correlation at least as large in
+        # magnitude as the observed one
+        mantel(self.output_dir, self.dm1, self.dm2, sequential_exceedances=7)
+
+        self.assertBasicVizValidity(self.output_dir, 3, permutations=7,
+                                    exp_p_value=1.0)
+
+    def test_sequential_mantel(self):
+        rng = np.random.default_rng(0)
+        ids = ['s%d' % i for i in range(10)]
+        dms = []
+        for _ in range(2):
+            data = rng.random((10, 10))
+            data = data + data.T
+            np.fill_diagonal(data, 0)
+            dms.append(skbio.DistanceMatrix(data, ids))
+        dm2 = dms[1].filter(ids[::-1])
+
+        for method in 'spearman', 'pearson':
+            exp_r, _, _ = skbio.stats.distance.mantel(
+                dms[0], dm2, method=method, permutations=0)
+            r, p, permutations = _sequential_mantel(dms[0], dm2, method,
+                                                    99, None)
+            self.assertAlmostEqual(r, exp_r)
+            self.assertEqual(permutations, 99)
+            self.assertTrue(0 < p <= 1)
+
+            r, p, permutations = _sequential_mantel(dms[0], dm2, method,
+                                                    999, 5)
+            self.assertAlmostEqual(r, exp_r)
+            self.assertLess(permutations, 999)
+            self.assertEqual(p, 5 / permutations)
+
     def test_zero_permutations(self):
         mantel(self.output_dir, self.dm1, self.dm2, permutations=0)
 
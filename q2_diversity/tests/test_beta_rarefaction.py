@@ -7,9 +7,9 @@
 # ----------------------------------------------------------------------------
 
 import unittest
-import functools
 import tempfile
 import os
+import pickle
 
 import skbio
 import qiime2
@@ -22,8 +22,10 @@ import scipy
 from qiime2.plugin.testing import TestPluginBase
 from q2_diversity import beta_rarefaction
 from q2_diversity._beta._beta_rarefaction import (
-    _get_multiple_rarefaction, _upgma, _cluster_samples, _add_support_count,
-    _jackknifed_emperor)
+    _get_multiple_rarefaction, _DistanceMatrixStack, _pairwise_mantel,
+    _row_correlations, _upgma, _linkage_clades, _clade_masks,
+    _neighbor_join, _cluster_samples, _add_support_count, _jackknifed_emperor,
+    _plotted_axes, _align_axes)
 
 
 class SharedSetup:
@@ -169,6 +171,49 @@ class BetaRarefactionTests(SharedSetup, TestPluginBase):
             beta_rarefaction(self.output_dir, table, 'braycurtis', 'upgma',
                              self.md, 2)
 
+    def test_beta_rarefaction_n_jobs(self):
+        beta_rarefaction(self.output_dir, self.table, 'braycurtis', 'upgma',
+                         self.md, 2, iterations=3, n_jobs=2)
+
+        self.assertBetaRarefactionValidity(
+            self.output_dir, 3, 'spearman', 'upgma')
+
+    def test_beta_rarefaction_multiple_metrics(self):
+        beta_rarefaction(self.output_dir, self.table, 'braycurtis', 'upgma',
+                         self.md, 2, iterations=3, phylogeny=self.tree,
+                         metrics={'weighted_unifrac'})
+
+        for metric in ('braycurtis', 'weighted_unifrac'):
+            self.assertBetaRarefactionValidity(
+                os.path.join(self.output_dir, metric), 3, 'spearman',
+                'upgma')
+        with open(os.path.join(self.output_dir, 'braycurtis',
+                               'heatmap.html')) as fh:
+            contents = fh.read()
+        self.assertIn('Heatmap - braycurtis', contents)
+        self.assertIn('../weighted_unifrac/tree.html', contents)
+        self.assertTrue(os.path.exists(
+            os.path.join(self.output_dir, 'index.html')))
+
+    def test_beta_rarefaction_metrics_including_metric(self):
+        beta_rarefaction(self.output_dir, self.table, 'braycurtis', 'upgma',
+                         self.md, 2, iterations=3, metrics={'braycurtis'})
+
+        self.assertBetaRarefactionValidity(
+            self.output_dir, 3, 'spearman', 'upgma')
+
+    def test_beta_rarefaction_pcoa_dimensions(self):
+        beta_rarefaction(self.output_dir, self.table, 'braycurtis', 'upgma',
+                         self.md, 2, iterations=3, pcoa_dimensions=3)
+
+        self.assertBetaRarefactionValidity(
+            self.output_dir, 3, 'spearman', 'upgma')
+
+    def test_beta_rarefaction_too_many_jobs(self):
+        with self.assertRaisesRegex(ValueError, 'physical cores'):
+            beta_rarefaction(self.output_dir, self.table, 'braycurtis',
+                             'upgma', self.md, 2, n_jobs=11117)
+
     def test_beta_rarefaction_missing_phylogeny(self):
         with self.assertRaisesRegex(ValueError, 'Phylogeny must be provided'):
             beta_rarefaction(self.output_dir, self.table,
@@ -180,40 +225,165 @@ class GetMultipleRarefactionTests(SharedSetup, TestPluginBase):
     package = 'q2_diversity.tests'
 
     def test_with_phylogeny(self):
-        with qiime2.sdk.Context() as scope:
-            table = qiime2.Artifact.import_data('FeatureTable[Frequency]',
-                                                self.table)
-            tree = qiime2.Artifact.import_data('Phylogeny[Rooted]',
-                                               self.tree)
-            api_method = scope.ctx.get_action('diversity', 'beta_phylogenetic')
-            beta_func = functools.partial(api_method, phylogeny=tree)
-            rare_func = scope.ctx.get_action('feature-table', 'rarefy')
-
-            for iterations in range(1, 4):
-                obs_dms = _get_multiple_rarefaction(
-                        beta_func, rare_func, 'weighted_unifrac',
-                        iterations, table, 2)
-
-                self.assertEqual(len(obs_dms), iterations)
-                for obs in obs_dms:
-                    self.assertEqual(obs.shape, (3, 3))
-                    self.assertEqual(set(obs.ids), set(['S1', 'S2', 'S3']))
+        for iterations in range(1, 4):
+            obs_dms = _get_multiple_rarefaction(
+                self.table, ['weighted_unifrac'], iterations, 2,
+                phylogeny=self.tree)['weighted_unifrac']
+
+            self.assertEqual(len(obs_dms), iterations)
+            for obs in obs_dms:
+                self.assertEqual(obs.shape, (3, 3))
+                self.assertEqual(set(obs.ids), set(['S1', 'S2', 'S3']))
 
     def test_without_phylogeny(self):
-        with qiime2.sdk.Context() as scope:
-            table = qiime2.Artifact.import_data('FeatureTable[Frequency]',
-                                                self.table)
-            beta_func = scope.ctx.get_action('diversity', 'beta')
-            rare_func = scope.ctx.get_action('feature-table', 'rarefy')
-            for iterations in range(1, 4):
-                obs_dms = _get_multiple_rarefaction(beta_func, rare_func,
-                                                    'braycurtis', iterations,
-                                                    table, 2)
-
-                self.assertEqual(len(obs_dms), iterations)
-                for obs in obs_dms:
-                    self.assertEqual(obs.shape, (3, 3))
-                    self.assertEqual(set(obs.ids), set(['S1', 'S2', 'S3']))
+        for iterations in range(1, 4):
+            obs_dms = _get_multiple_rarefaction(
+                self.table, ['braycurtis'], iterations, 2)['braycurtis']
+
+            self.assertEqual(len(obs_dms), iterations)
+            for obs in obs_dms:
+                self.assertEqual(obs.shape, (3, 3))
+                self.assertEqual(set(obs.ids), set(['S1', 'S2', 'S3']))
+
+    def test_multiple_metrics(self):
+        np.random.seed(0)
+        obs = _get_multiple_rarefaction(
+            self.table, ['braycurtis', 'jaccard', 'weighted_unifrac'], 3, 2,
+            phylogeny=self.tree)
+        np.random.seed(0)
+        exp = _get_multiple_rarefaction(self.table, ['braycurtis'], 3, 2)
+
+        self.assertEqual(set(obs),
+                         {'braycurtis', 'jaccard', 'weighted_unifrac'})
+        for dms in obs.values():
+            self.assertEqual(len(dms), 3)
+        # the same rarefied tables are used whichever metrics are requested
+        self.assertEqual(list(obs['braycurtis']), list(exp['braycurtis']))
+
+    def test_n_jobs_reproducible(self):
+        obs = {}
+        for n_jobs in (1, 2):
+            np.random.seed(0)
+            obs[n_jobs] = _get_multiple_rarefaction(
+                self.table, ['braycurtis', 'jaccard'], 4, 2, n_jobs=n_jobs)
+
+        for metric in ('braycurtis', 'jaccard'):
+            self.assertEqual(obs[1][metric].ids, obs[2][metric].ids)
+            npt.assert_array_equal(obs[1][metric].condensed,
+                                   obs[2][metric].condensed)
+
+    def test_all_samples_dropped(self):
+        with self.assertRaisesRegex(ValueError,
+                                    'shallow enough sampling depth'):
+            _get_multiple_rarefaction(self.table, ['braycurtis'], 2, 6)
+
+
+class DistanceMatrixStackTests(unittest.TestCase):
+    def setUp(self):
+        self.dms = [
+            skbio.DistanceMatrix([[0, 1, 2], [1, 0, 3], [2, 3, 0]],
+                                 ids=['S1', 'S2', 'S3']),
+            skbio.DistanceMatrix([[0, 4, 5], [4, 0, 6], [5, 6, 0]],
+                                 ids=['S1', 'S2', 'S3'])]
+
+    def test_round_trip(self):
+        stack = _DistanceMatrixStack(['S1', 'S2', 'S3'], 2)
+        for i, dm in enumerate(self.dms):
+            stack[i] = dm
+
+        self.assertEqual(len(stack), 2)
+        self.assertEqual(list(stack), self.dms)
+        npt.assert_array_equal(stack.condensed, [[1, 2, 3], [4, 5, 6]])
+        self.assertEqual(stack.condensed.dtype, np.float32)
+
+    def test_slice(self):
+        stack = _DistanceMatrixStack(['S1', 'S2', 'S3'], 2)
+        support = stack[1:]
+        for i, dm in enumerate(self.dms):
+            stack[i] = dm
+
+        self.assertEqual(len(support), 1)
+        self.assertEqual(support[0], self.dms[1])
+
+    def test_reorders_ids(self):
+        stack = _DistanceMatrixStack(['S1', 'S2', 'S3'], 1)
+        stack[0] = self.dms[1].filter(['S3', 'S1', 'S2'])
+
+        self.assertEqual(stack[0], self.dms[1])
+
+    def test_mismatched_ids(self):
+        stack = _DistanceMatrixStack(['S1', 'S2', 'S4'], 1)
+
+        with self.assertRaisesRegex(ValueError, 'not in both'):
+            stack[0] = self.dms[0]
+
+    def test_pickle_shares_storage(self):
+        stack = _DistanceMatrixStack(['S1', 'S2', 'S3'], 2)
+        for i, dm in enumerate(self.dms):
+            stack[i] = dm
+
+        obs = pickle.loads(pickle.dumps(stack[1:]))
+
+        self.assertIsInstance(obs.condensed, np.memmap)
+        self.assertEqual(obs.condensed.filename, stack.condensed.filename)
+        self.assertEqual(list(obs), self.dms[1:])
+        # matrices set through the unpickled stack are in the original
+        obs[0] = self.dms[0]
+        self.assertEqual(stack[1], self.dms[0])
+
+
+class PairwiseMantelTests(unittest.TestCase):
+    def setUp(self):
+        ids = ['S1', 'S2', 'S3', 'S4']
+        self.dms = [
+            skbio.DistanceMatrix([[0, 1, 2, 2], [1, 0, 3, 1], [2, 3, 0, 4],
+                                  [2, 1, 4, 0]], ids=ids),
+            skbio.DistanceMatrix([[0, 2, 1, 2], [2, 0, 3, 3], [1, 3, 0, 5],
+                                  [2, 3, 5, 0]], ids=ids),
+            skbio.DistanceMatrix([[0, 4, 1, 1], [4, 0, 2, 3], [1, 2, 0, 1],
+                                  [1, 3, 1, 0]], ids=ids)]
+
+    def test_matches_pairwise_correlations(self):
+        for method, corr in (('spearman', scipy.stats.spearmanr),
+                             ('pearson', scipy.stats.pearsonr)):
+            obs = _pairwise_mantel(self.dms, method)
+
+            self.assertEqual(list(obs.index), [(0, 1), (0, 2), (1, 2)])
+            self.assertEqual(obs.index.names, ['dm1', 'dm2'])
+            exp = [corr(self.dms[i].condensed_form(),
+                        self.dms[j].condensed_form())[0]
+                   for i, j in obs.index]
+            npt.assert_almost_equal(obs['statistic'], exp)
+            self.assertTrue(obs['p-value'].isna().all())
+            self.assertEqual(set(obs['n']), {4})
+            self.assertEqual(set(obs['method']), {method})
+
+    def test_reorders_ids(self):
+        dms = [self.dms[0], self.dms[1].filter(['S3', 'S1', 'S4', 'S2'])]
+
+        obs = _pairwise_mantel(dms, 'spearman')
+
+        exp = scipy.stats.spearmanr(self.dms[0].condensed_form(),
+                                    self.dms[1].condensed_form())[0]
+        npt.assert_almost_equal(obs.loc[(0, 1), 'statistic'], exp)
+
+    def test_mismatched_ids(self):
+        dms = [self.dms[0], self.dms[1].filter(['S1', 'S2', 'S3'])]
+
+        with self.assertRaisesRegex(ValueError, 'not in both'):
+            _pairwise_mantel(dms, 'spearman')
+
+    def test_too_small(self):
+        dms = [dm.filter(['S1', 'S2']) for dm in self.dms]
+
+        with self.assertRaisesRegex(ValueError, '3x3 in size'):
+            _pairwise_mantel(dms, 'pearson')
+
+    def test_row_correlations_blocks(self):
+        rows = np.random.RandomState(0).rand(4, 25)
+
+        npt.assert_almost_equal(_row_correlations(rows, block_size=8),
+                                np.corrcoef(rows))
 
 
 class UPGMATests(unittest.TestCase):
@@ -244,6 +414,66 @@ class UPGMATests(unittest.TestCase):
         self.assertIs(c.parent.parent, d.parent)
         self.assertIs(d.parent.parent, None)
 
+    def test_linkage_clades(self):
+        ids = ['S%d' % i for i in range(20)]
+        condensed = np.random.RandomState(0).rand(190)
+        linkage = scipy.cluster.hierarchy.average(condensed)
+        tip_index = {}
+        exp = set(_clade_masks(
+            skbio.TreeNode.from_linkage_matrix(linkage, ids),
+            tip_index).values())
+
+        obs = _linkage_clades(linkage, ids, tip_index)
+
+        self.assertEqual(obs, exp)
+
+
+class NeighborJoinTests(unittest.TestCase):
+    def test_wikipedia_example(self):
+        # the example from the skbio.tree.nj documentation
+        data = [[0, 5, 9, 9, 8],
+                [5, 0, 10, 10, 9],
+                [9, 10, 0, 8, 7],
+                [9, 10, 8, 0, 3],
+                [8, 9, 7, 3, 0]]
+
+        obs = _neighbor_join(data, list('abcde'))
+
+        exp = skbio.TreeNode.read(
+            ['(d:2.0,(c:4.0,(b:3.0,a:2.0):3.0):2.0,e:1.0);'])
+        self.assertEqual(str(obs), str(exp))
+
+    def test_ties(self):
+        # Every pair ties in the first step, and scikit-bio joins the pair
+        # nearest to the top left of the Q matrix, (1, 0).
+        data = [[0, 1, 1, 1],
+                [1, 0, 1, 1],
+                [1, 1, 0, 1],
+                [1, 1, 1, 0]]
+
+        obs = _neighbor_join(data, list('abcd'))
+
+        self.assertIs(obs.find('a').parent, obs.find('b').parent)
+        self.assertEqual(obs.find('b').parent.children[0].name, 'b')
+
+    def test_additive_distances(self):
+        # neighbor joining recovers the tree that the distances were
+        # measured on
+        points = np.random.RandomState(0).rand(30, 2)
+        linkage = scipy.cluster.hierarchy.average(
+            scipy.spatial.distance.pdist(points))
+        ids = ['S%d' % i for i in range(30)]
+        exp = skbio.TreeNode.from_linkage_matrix(
+            linkage, ids).tip_tip_distances(ids)
+
+        obs = _neighbor_join(exp.data, ids).tip_tip_distances(ids)
+
+        npt.assert_allclose(obs.data, exp.data)
+
+    def test_too_small(self):
+        with self.assertRaisesRegex(ValueError, 'at least 3x3'):
+            _neighbor_join([[0, 1], [1, 0]], ['a', 'b'])
+
 
 class ClusterSamplesTests(unittest.TestCase):
     def setUp(self):
@@ -298,8 +528,20 @@ class ClusterSamplesTests(unittest.TestCase):
         self.assertIs(s3.parent, s1_s2.parent)
         self.assertIs(s3.parent.name, 'root')  # root support is pointless
 
+    def test_support_n_jobs(self):
+        exp = _cluster_samples(self.dm, self.support, 'upgma')
+        obs = _cluster_samples(self.dm, self.support, 'upgma', n_jobs=2)
+
+        self.assertEqual(str(obs), str(exp))
+
 
 class AddSupportCountTests(unittest.TestCase):
+    def add_support_count(self, internal, support):
+        tip_index = {}
+        masks = _clade_masks(internal[0].root(), tip_index)
+        support_clades = set(_clade_masks(support, tip_index).values())
+        _add_support_count(internal, masks, support_clades)
+
     def test_same_topology(self):
         p = skbio.TreeNode.read(['((a,b),c);'])
         s = skbio.TreeNode.read(['((a,b),c);'])
@@ -308,7 +550,7 @@ class AddSupportCountTests(unittest.TestCase):
         for n in internal:
             n.support_count = 0
 
-        _add_support_count(internal, s)
+        self.add_support_count(internal, s)
 
         for n in internal:
             self.assertEqual(n.support_count, 1)
@@ -321,7 +563,7 @@ class AddSupportCountTests(unittest.TestCase):
         for n in internal:
             n.support_count = 0
 
-        _add_support_count(internal, s)
+        self.add_support_count(internal, s)
 
         a_b = p.find('a').parent
         a_b_c = a_b.parent
@@ -338,7 +580,7 @@ class AddSupportCountTests(unittest.TestCase):
         for n in internal:
             n.support_count = 0
 
-        _add_support_count(internal, s)
+        self.add_support_count(internal, s)
 
         a_b = p.find('a').parent
         a_b_c = a_b.parent
@@ -356,8 +598,8 @@ class AddSupportCountTests(unittest.TestCase):
         for n in internal:
             n.support_count = 0
 
-        _add_support_count(internal, s1)
-        _add_support_count(internal, s2)
+        self.add_support_count(internal, s1)
+        self.add_support_count(internal, s2)
 
         a_b = p.find('a').parent
         a_b_c = a_b.parent
@@ -367,6 +609,21 @@ class AddSupportCountTests(unittest.TestCase):
         self.assertEqual(a_b_c.support_count, 1)
         self.assertEqual(a_b_c_d.support_count, 2)
 
+    def test_differing_tip_order(self):
+        p = skbio.TreeNode.read(['(((a,b),(c,d)),(e,f));'])
+        s = skbio.TreeNode.read(['((f,e),((d,(b,a)),c));'])
+
+        internal = list(p.non_tips())
+        for n in internal:
+            n.support_count = 0
+
+        self.add_support_count(internal, s)
+
+        self.assertEqual(p.find('a').parent.support_count, 1)
+        self.assertEqual(p.find('c').parent.support_count, 0)
+        self.assertEqual(p.find('e').parent.support_count, 1)
+        self.assertEqual(p.find('a').parent.parent.support_count, 1)
+
 
 class JackknifedEmperorTests(SharedSetup, unittest.TestCase):
     def test_simple(self):
@@ -384,6 +641,49 @@ class JackknifedEmperorTests(SharedSetup, unittest.TestCase):
 
         self.assertEqual(len(e.jackknifed), 3)
 
+    def test_pcoa_dimensions(self):
+        dm = skbio.DistanceMatrix([[0, 1, 2], [1, 0, 3], [2, 3, 0]],
+                                  ids=['S1', 'S2', 'S3'])
+        j1 = skbio.DistanceMatrix([[0, 1.1, 2], [1.1, 0, 3], [2, 3, 0]],
+                                  ids=['S1', 'S2', 'S3'])
+        exp_dm, exp_j1 = dm.copy(), j1.copy()
+
+        e = _jackknifed_emperor(dm, [j1], self.md, pcoa_dimensions=3)
+
+        self.assertEqual(e.ordination.samples.shape, (3, 3))
+        self.assertEqual(e.jackknifed[0].samples.shape, (3, 3))
+        # the caller's matrices aren't centered in place
+        self.assertEqual(dm, exp_dm)
+        self.assertEqual(j1, exp_j1)
+
+    def test_plotted_axes(self):
+        dm = skbio.DistanceMatrix(
+            scipy.spatial.distance.squareform(np.arange(1, 29)),
+            ids=['S%d' % i for i in range(8)])
+        ordination = skbio.stats.ordination.pcoa(dm)
+
+        obs = _plotted_axes(ordination)
+
+        self.assertEqual(obs.samples.shape, (8, 5))
+        pd.testing.assert_frame_equal(obs.samples,
+                                      ordination.samples.iloc[:, :5])
+        pd.testing.assert_series_equal(obs.eigvals,
+                                       ordination.eigvals[:5])
+        pd.testing.assert_series_equal(
+            obs.proportion_explained, ordination.proportion_explained[:5])
+
+    def test_align_axes(self):
+        reference = pd.DataFrame([[1, 2, 0.5], [-1, 1, 0.5], [0, -3, -1]],
+                                 index=['S1', 'S2', 'S3'])
+        samples = pd.DataFrame([[-1, 2], [0, -3], [1, 1]],
+                               index=['S1', 'S3', 'S2'])
+
+        obs = _align_axes(samples, reference)
+
+        exp = pd.DataFrame([[1, 2], [0, -3], [-1, 1]],
+                           index=['S1', 'S3', 'S2'])
+        pd.testing.assert_frame_equal(obs, exp, check_dtype=False)
+
 
 if __name__ == "__main__":
     unittest.main()
@@ -0,0 +1,90 @@
+# ----------------------------------------------------------------------------
+# Copyright (c) 2016-2021, QIIME 2 development team.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# ----------------------------------------------------------------------------
+
+import os
+import pickle
+import unittest
+
+import numpy as np
+import numpy.testing as npt
+
+from q2_diversity._parallel import (_resolve_n_jobs, _parallel_map,
+                                    _SharedArray)
+
+
+def _scale_and_tag(shared, task):
+    return shared * task, os.getpid()
+
+
+def _shared_row_sum(shared, task):
+    return shared.array[task].sum()
+
+
+class ResolveNJobsTests(unittest.TestCase):
+    def test_explicit(self):
+        self.assertEqual(_resolve_n_jobs(1), 1)
+
+    def test_auto(self):
+        self.assertGreaterEqual(_resolve_n_jobs('auto'), 1)
+
+    def test_too_many_jobs(self):
+        # cannot guarantee that this will always be true, but it would be
+        # odd to see a machine with these many CPUs
+        with self.assertRaisesRegex(ValueError, '11117.*exceeds'):
+            _resolve_n_jobs(11117)
+
+
+class ParallelMapTests(unittest.TestCase):
+    def test_serial_runs_in_process(self):
+        obs = list(_parallel_map(_scale_and_tag, 3, range(5), 1))
+
+        self.assertEqual([value for value, _ in obs], [0, 3, 6, 9, 12])
+        self.assertEqual({pid for _, pid in obs}, {os.getpid()})
+
+    def test_parallel_preserves_order(self):
+        obs = list(_parallel_map(_scale_and_tag, 3, range(25), 2))
+
+        self.assertEqual([value for value, _ in obs],
+                         [3 * i for i in range(25)])
+        self.assertNotIn(os.getpid(), {pid for _, pid in obs})
+
+    def test_no_tasks(self):
+        self.assertEqual(list(_parallel_map(_scale_and_tag, 3, [], 2)), [])
+
+
+class SharedArrayTests(unittest.TestCase):
+    def test_not_copied_in_process(self):
+        array = np.arange(6.0).reshape(2, 3)
+        shared = _SharedArray(array)
+
+        self.assertIs(shared.array, array)
+        self.assertEqual(list(_parallel_map(_shared_row_sum, shared,
+                                            range(2), 1)), [3.0, 12.0])
+
+    def test_pickle_maps_file(self):
+        array = np.arange(6.0).reshape(2, 3)
+        shared = _SharedArray(array)
+
+        first = pickle.loads(pickle.dumps(shared))
+        second = pickle.loads(pickle.dumps(shared))
+
+        npt.assert_array_equal(first.array, array)
+        self.assertIsInstance(first.array, np.memmap)
+        self.assertFalse(first.array.flags.writeable)
+        self.assertEqual(first.array.filename, second.array.filename)
+
+    def test_parallel(self):
+        array = np.arange(12.0).reshape(4, 3)
+        obs = list(_parallel_map(_shared_row_sum, _SharedArray(array),
+                                 range(4), 2))
+
+        self.assertEqual(obs, [3.0, 12.0, 21.0, 30.0])
+
+
+if __name__ == '__main__':
+    unittest.main()
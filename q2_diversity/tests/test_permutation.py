@@ -0,0 +1,56 @@
+# ----------------------------------------------------------------------------
+# Copyright (c) 2016-2021, QIIME 2 development team.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# ----------------------------------------------------------------------------
+
+import unittest
+
+import numpy as np
+
+from q2_diversity._permutation import _monte_carlo_p_value
+
+
+class MonteCarloPValueTests(unittest.TestCase):
+    def test_all_permutations(self):
+        exceeded = [[True, False, False], [False, True, False, False]]
+
+        p, run = _monte_carlo_p_value(iter(exceeded))
+
+        self.assertEqual(p, 3 / 8)
+        self.assertEqual(run, 7)
+
+    def test_no_permutations(self):
+        p, run = _monte_carlo_p_value(iter([]))
+
+        self.assertTrue(np.isnan(p))
+        self.assertEqual(run, 0)
+
+    def test_stops_at_exceedances(self):
+        consumed = []
+
+        def exceeded():
+            for batch in ([False, True], [False, True, True, True], [True]):
+                consumed.append(batch)
+                yield batch
+
+        # the third exceedance is the fifth permutation
+        p, run = _monte_carlo_p_value(exceeded(), exceedances=3)
+
+        self.assertEqual(p, 3 / 5)
+        self.assertEqual(run, 5)
+        self.assertEqual(len(consumed), 2)
+
+    def test_too_few_exceedances(self):
+        exceeded = [[False, True], [False, False, True]]
+
+        p, run = _monte_carlo_p_value(iter(exceeded), exceedances=3)
+
+        self.assertEqual(p, 3 / 6)
+        self.assertEqual(run, 5)
+
+
+if __name__ == '__main__':
+    unittest.main()
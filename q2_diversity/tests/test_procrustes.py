@@ -148,6 +148,18 @@ class PCoATests(unittest.TestCase):
         self.assertAlmostEqual(true_m2, self.expected_m2)
         self.assertTrue(np.isnan(true_p_value))
 
+    def test_sequential_exceedances(self):
+        # about half of the permutations give a lower M^2 value, so it would
+        # be very unlikely for all of them to be run
+        _, _, m2_results = procrustes_analysis(self.reference, self.other,
+                                               permutations=999,
+                                               sequential_exceedances=2)
+        permutations = m2_results['number of Monte Carlo permutations'][0]
+        p_value = m2_results['p-value for true M^2 value'][0]
+
+        self.assertLess(permutations, 999)
+        self.assertAlmostEqual(p_value, 2 / permutations)
+
     def test_procrustes_bad_dimensions(self):
 
         self.other.samples = self.other.samples.iloc[:, :4]
@@ -0,0 +1,123 @@
+# ----------------------------------------------------------------------------
+# Copyright (c) 2016-2021, QIIME 2 development team.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# ----------------------------------------------------------------------------
+
+import unittest
+
+import biom
+import numpy as np
+import numpy.testing as npt
+
+from q2_diversity._subsample import _DepthSortedCounts, _nested_rarefy
+
+
+class NestedRarefyTests(unittest.TestCase):
+    def setUp(self):
+        self.table = biom.Table(np.array([[150, 100, 5],
+                                          [50, 100, 0],
+                                          [0, 0, 1]]),
+                                ['O1', 'O2', 'O3'], ['S1', 'S2', 'S3'])
+
+    def test_depths_and_totals(self):
+        obs = list(_nested_rarefy(self.table, [200, 1, 4],
+                                  np.random.default_rng(0)))
+
+        self.assertEqual([depth for depth, _ in obs], [1, 4, 200])
+        for depth, table in obs:
+            npt.assert_array_equal(table.sum(axis='sample'), depth)
+
+    def test_shallow_samples_dropped(self):
+        obs = dict(_nested_rarefy(self.table, [1, 7, 200],
+                                  np.random.default_rng(0)))
+
+        self.assertEqual(list(obs[1].ids()), ['S1', 'S2', 'S3'])
+        self.assertEqual(list(obs[7].ids()), ['S1', 'S2'])
+        self.assertEqual(list(obs[200].ids()), ['S1', 'S2'])
+
+    def test_empty_features_dropped(self):
+        obs = dict(_nested_rarefy(self.table, [200],
+                                  np.random.default_rng(0)))
+
+        self.assertEqual(list(obs[200].ids(axis='observation')),
+                         ['O1', 'O2'])
+
+    def test_full_depth_is_input(self):
+        obs = dict(_nested_rarefy(self.table, [200],
+                                  np.random.default_rng(0)))
+
+        npt.assert_array_equal(obs[200].matrix_data.toarray(),
+                               [[150, 100], [50, 100]])
+
+    def test_depths_are_nested(self):
+        obs = list(_nested_rarefy(self.table, [1, 2, 3, 4, 50, 100, 200],
+                                  np.random.default_rng(42)))
+
+        for (_, shallow), (_, deep) in zip(obs, obs[1:]):
+            for sample in deep.ids():
+                if not shallow.exists(sample):
+                    continue
+                for feature in shallow.ids(axis='observation'):
+                    value = shallow.get_value_by_ids(feature, sample)
+                    if value > 0:
+                        self.assertGreaterEqual(
+                            deep.get_value_by_ids(feature, sample), value)
+
+    def test_seeded_draws_reproducible(self):
+        obs1 = list(_nested_rarefy(self.table, [3, 50],
+                                   np.random.default_rng(7)))
+        obs2 = list(_nested_rarefy(self.table, [3, 50],
+                                   np.random.default_rng(7)))
+
+        for (_, t1), (_, t2) in zip(obs1, obs2):
+            self.assertEqual(t1, t2)
+
+    def test_input_sample_order_kept(self):
+        table = biom.Table(np.array([[1, 50, 10], [0, 50, 10]]),
+                           ['O1', 'O2'], ['S1', 'S2', 'S3'])
+
+        obs = dict(_nested_rarefy(table, [1, 20], np.random.default_rng(0)))
+
+        self.assertEqual(list(obs[1].ids()), ['S1', 'S2', 'S3'])
+        self.assertEqual(list(obs[20].ids()), ['S2', 'S3'])
+
+    def test_from_depth_sorted_counts(self):
+        counts = _DepthSortedCounts(self.table)
+        obs1 = list(_nested_rarefy(counts, [3, 50],
+                                   np.random.default_rng(7)))
+        obs2 = list(_nested_rarefy(self.table, [3, 50],
+                                   np.random.default_rng(7)))
+
+        for (_, t1), (_, t2) in zip(obs1, obs2):
+            self.assertEqual(t1, t2)
+
+
+class DepthSortedCountsTests(unittest.TestCase):
+    def setUp(self):
+        self.table = biom.Table(np.array([[1, 50, 10], [0, 50, 10]]),
+                                ['O1', 'O2'], ['S1', 'S2', 'S3'])
+
+    def test_sorted_by_total(self):
+        obs = _DepthSortedCounts(self.table)
+
+        npt.assert_array_equal(obs.totals, [100, 20, 1])
+        npt.assert_array_equal(obs.order, [1, 2, 0])
+        npt.assert_array_equal(obs.counts.toarray(),
+                               [[50, 50], [10, 10], [1, 0]])
+        npt.assert_array_equal(obs.sample_ids, ['S1', 'S2', 'S3'])
+
+    def test_eligible(self):
+        obs = _DepthSortedCounts(self.table)
+
+        self.assertEqual(obs.eligible(1), 3)
+        self.assertEqual(obs.eligible(2), 2)
+        self.assertEqual(obs.eligible(20), 2)
+        self.assertEqual(obs.eligible(21), 1)
+        self.assertEqual(obs.eligible(101), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()